@@ -3,10 +3,52 @@ Registration module main code.
 """
 
 import numpy as np
-from scipy import ndimage
+from scipy import ndimage, optimize, sparse
+import itertools
+from functools import partial
+from contextlib import contextmanager
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 import registration_util as util
 
 
+# Floating point type of the coordinates of the image transformations
+# and of the images in the similarity metrics. Single precision halves
+# the memory traffic of these bandwidth-bound operations; the parameters
+# of the transformations and the optimizers always use double precision.
+# Comparison of single with double precision on 1_1_t1/1_1_t1_d (see
+# registration_benchmark.compare_precision()):
+# - image_transform: one grey value difference in 0.002% of the pixels
+#   of the uint8 images; same time (map_coordinates dominates), half
+#   the peak memory
+# - correlation: absolute difference 2e-6, 1.8x faster
+# - joint histogram and mutual information (64 bins): absolute
+#   difference 3e-6, 1.2-1.4x faster; the analytic gradient of the
+#   mutual information can change by 10% when a few pixels of a uint8
+#   transformed image change one grey value, as it does for tiny
+#   parameter changes in double precision
+# - affine_corr registration (100 iterations of gradient ascent with
+#   ngradient()): final similarity and parameters differ by 5e-3, since
+#   the finite differences amplify the rounding errors of the similarity;
+#   1.4x faster with half the peak memory
+FLOAT_DTYPE = np.float64
+
+
+def set_float_dtype(dtype):
+    # Set the floating point type used by the registration (np.float32
+    # or np.float64). Metric functions such as correlation_metric() keep
+    # the type they were created with. The type is set per process.
+    # Input:
+    # dtype - np.float32 or np.float64
+
+    global FLOAT_DTYPE
+
+    dtype = np.dtype(dtype).type
+    if dtype not in (np.float32, np.float64):
+        raise AssertionError("The floating point type must be np.float32 or np.float64.")
+
+    FLOAT_DTYPE = dtype
+
+
 # SECTION 1. Geometrical transformations
 
 
@@ -86,17 +128,207 @@ def reflect(rx, ry):
     return T
 
 
+def rigid_matrix(x, scaling=100):
+    # Homogeneous matrix of a rigid transformation, computed in closed
+    # form (the same as util.t2h(rotate(x[0]), x[1:]*scaling)).
+    # Input:
+    # x - parameters of the rigid transformation, see rigid_corr()
+    # scaling - scaling factor of the translation parameters
+    # Output:
+    # Th - homogeneous transformation matrix
+
+    c = np.cos(x[0])
+    s = np.sin(x[0])
+
+    Th = np.array([[c, -s, x[1]*scaling],
+                   [s, c, x[2]*scaling],
+                   [0., 0., 1.]])
+
+    return Th
+
+
+def affine_matrix(x, scaling=100):
+    # Homogeneous matrix of an affine transformation, computed in closed
+    # form (the same as util.t2h(rotate(x[0]).dot(scale(x[1], x[2]).dot(
+    # shear(x[3], x[4]))), x[5:]*scaling)).
+    # Input:
+    # x - parameters of the affine transformation, see affine_corr()
+    # scaling - scaling factor of the translation parameters
+    # Output:
+    # Th - homogeneous transformation matrix
+
+    c = np.cos(x[0])
+    s = np.sin(x[0])
+    sx, sy, cx, cy = x[1:5]
+
+    Th = np.array([[c*sx - s*sy*cy, c*sx*cx - s*sy, x[5]*scaling],
+                   [s*sx + c*sy*cy, s*sx*cx + c*sy, x[6]*scaling],
+                   [0., 0., 1.]])
+
+    return Th
+
+
+class Transform:
+    # Homogeneous transformation with a cached inverse. Transforms are
+    # composed with the @ operator: A @ B maps a point first with B and
+    # then with A, like A.dot(B) for matrices. Compositions are lazy:
+    # the product of all matrices in a chain A @ B @ C is computed once,
+    # when the matrix or the inverse is first needed. A Transform can be
+    # used wherever a homogeneous matrix is expected (np.asarray(T) is
+    # the matrix), and image_transform() uses its cached inverse.
+    # Input:
+    # matrix - homogeneous transformation matrix
+
+    __slots__ = ('_matrix', '_factors', '_inverse')
+
+    # keep numpy from handling array @ Transform itself
+    __array_ufunc__ = None
+
+    def __init__(self, matrix):
+        self._matrix = np.array(matrix, dtype=float)
+        self._matrix.flags.writeable = False
+        self._factors = None
+        self._inverse = None
+
+    @classmethod
+    def rigid(cls, x, scaling=100):
+        # Transform with the parameters of rigid_corr().
+        return cls(rigid_matrix(x, scaling))
+
+    @classmethod
+    def affine(cls, x, scaling=100):
+        # Transform with the parameters of affine_corr().
+        return cls(affine_matrix(x, scaling))
+
+    @property
+    def matrix(self):
+        # Homogeneous transformation matrix (read-only).
+        if self._matrix is None:
+            matrices = [T.matrix for T in self._factors]
+            self._matrix = np.linalg.multi_dot(matrices) if len(matrices) > 2 else matrices[0].dot(matrices[1])
+            self._matrix.flags.writeable = False
+            self._factors = None
+        return self._matrix
+
+    @property
+    def inverse(self):
+        # Inverse transformation, computed once.
+        if self._inverse is None:
+            self._inverse = Transform(util.inv_h(self.matrix))
+            self._inverse._inverse = self
+        return self._inverse
+
+    def apply(self, X):
+        # Transform points in homogeneous coordinates.
+        return self.matrix.dot(X)
+
+    def __matmul__(self, other):
+        if not isinstance(other, Transform):
+            other = Transform(other)
+
+        # the factors of a composition that has not been computed yet
+        # are taken over, so that the whole chain is multiplied at once
+        factors = []
+        for T in (self, other):
+            factors.extend(T._factors if T._matrix is None else (T,))
+
+        T = Transform.__new__(Transform)
+        T._matrix = None
+        T._factors = tuple(factors)
+        T._inverse = None
+
+        return T
+
+    def __rmatmul__(self, other):
+        return Transform(other) @ self
+
+    def __array__(self, dtype=None, copy=None):
+        return self.matrix if dtype is None else self.matrix.astype(dtype)
+
+    def __repr__(self):
+        return 'Transform(' + repr(self.matrix) + ')'
+
+
 # SECTION 2. Image transformation and least squares fitting
 
 
-def image_transform(I, Th,  output_shape=None):
+class SplineImage:
+    # Image with precomputed spline coefficients for interpolation of
+    # order 2 or higher. map_coordinates() runs a spline prefilter over
+    # the whole image for every transformation with such an order; the
+    # image transformations below use the coefficients of a SplineImage
+    # directly, so the prefilter only runs once for all transformations
+    # of the same moving image. The transformed images have the type of
+    # the original image.
+    # Input:
+    # image - image (2D image or 3D volume)
+    # order - order of the spline interpolation (2 to 5)
+
+    __slots__ = ('image', 'coefficients', 'order')
+
+    def __init__(self, image, order=3):
+        if order < 2 or order > 5:
+            raise AssertionError("The order of the spline must be between 2 and 5.")
+
+        self.image = image
+        self.order = order
+        # map_coordinates() filters with the same mode as it interpolates
+        self.coefficients = ndimage.spline_filter(image, order, output=np.float64, mode='constant')
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    @property
+    def ndim(self):
+        return self.image.ndim
+
+    @property
+    def dtype(self):
+        return self.image.dtype
+
+    def __array__(self, dtype=None, copy=None):
+        return self.image if dtype is None else self.image.astype(dtype)
+
+
+def interpolation_input(I, order=1):
+    # Input and options of map_coordinates() for the interpolation of an
+    # image or a SplineImage.
+    # Input:
+    # I - image or SplineImage
+    # order - interpolation order for images (SplineImage objects use
+    # their own order)
+    # Output:
+    # data - image or spline coefficients to interpolate
+    # options - order, prefilter and mode of map_coordinates()
+
+    if isinstance(I, SplineImage):
+        return I.coefficients, {'order': I.order, 'prefilter': False, 'mode': 'constant'}
+
+    return I, {'order': order, 'mode': 'constant'}
+
+
+def image_transform(I, Th,  output_shape=None, samples=None, chunk_size=None, order=1):
     # Image transformation by inverse mapping.
     # Input:
-    # I - image to be transformed
-    # Th - homogeneous transformation matrix
+    # I - image to be transformed (2D image or 3D volume), or a
+    # SplineImage for spline interpolation without a prefilter per call
+    # Th - homogeneous transformation matrix (3-by-3 for 2D images,
+    # 4-by-4 for 3D volumes)
     # output_shape - size of the output image (default is same size as input)
+    # samples - optional (flat) indices of the output pixels to compute,
+    # for example from sample_pixels()
+    # chunk_size - optional number of output pixels that are mapped and
+    # interpolated at a time, so that the coordinates of the whole image
+    # are never in memory at once (useful for 3D volumes)
+    # order - interpolation order (default: 1, linear); for orders of 2
+    # and higher pass a SplineImage, so that the spline coefficients are
+    # not computed for every transformation
     # Output:
-    # It - transformed image
+    # It - transformed image, or a column-vector with the values of the
+    # sampled pixels if samples is given
+    # Xt - inverse mapped homogeneous coordinates (None if chunk_size is
+    # given)
     # we want double precision for the interpolation, but we want the
     # output to have the same data type as the input - so, we will
     # convert to double and remember the original input type
@@ -107,28 +339,313 @@ def image_transform(I, Th,  output_shape=None):
     if output_shape is None:
         output_shape = I.shape
 
-    # spatial coordinates of the transformed image
-    x = np.arange(0, output_shape[1])
-    y = np.arange(0, output_shape[0])
-    xx, yy = np.meshgrid(x, y)
-
-    # convert to a 2-by-p matrix (p is the number of pixels)
-    X = np.concatenate((xx.reshape((1, xx.size)), yy.reshape((1, yy.size))))
-    # convert to homogeneous coordinates
-    Xh = util.c2h(X)
+    n = I.ndim
+    inverse = Th.inverse.matrix if isinstance(Th, Transform) else util.inv_h(Th)
+    inverse = inverse.astype(FLOAT_DTYPE)
+
+    output_type = I.dtype
+    data, options = interpolation_input(I, order)
+
+    if chunk_size is not None and samples is None:
+        It = np.empty(int(np.prod(output_shape)), dtype=output_type)
+        for start in range(0, It.size, chunk_size):
+            # homogeneous coordinates of the pixels in this chunk
+            idx = np.unravel_index(np.arange(start, min(start+chunk_size, It.size)), output_shape)
+            Xh = np.vstack(idx[::-1] + (np.ones(idx[0].size),)).astype(FLOAT_DTYPE)
+            with util.stage('coordinate_mapping'):
+                Xt = inverse.dot(Xh)
+            with util.stage('interpolation'):
+                It[start:start+chunk_size] = ndimage.map_coordinates(data, Xt[n-1::-1], output=output_type, **options)
+        return It.reshape(output_shape), None
+
+    # spatial coordinates of the transformed image as a (n+1)-by-p
+    # matrix of homogeneous coordinates (p is the number of pixels),
+    # shared by all transformations with the same output size
+    Xh = util.sampling_grid(*output_shape, dtype=FLOAT_DTYPE)
+
+    if samples is not None:
+        Xh = Xh[:, samples]
+        output_shape = (Xh.shape[1], 1)
 
     #------------------------------------------------------------------#
     # TODO: Perform inverse coordinates mapping.
-    inverse = np.linalg.inv(Th)
-    Xt = inverse.dot(Xh)
+    with util.stage('coordinate_mapping'):
+        Xt = inverse.dot(Xh)
 
     #------------------------------------------------------------------#
 
-    It = ndimage.map_coordinates(I, [Xt[1,:], Xt[0,:]], order=1, mode='constant').reshape(I.shape)
+    # the coordinates are in (x, y, ...) order and the image axes in
+    # (..., y, x) order
+    with util.stage('interpolation'):
+        It = ndimage.map_coordinates(data, Xt[n-1::-1], output=output_type, **options).reshape(output_shape)
 
     return It, Xt
 
 
+def image_transform_batch(I, Th, output_shape=None, chunk_size=16, order=1):
+    # Transformation of one image with a stack of transformation
+    # matrices. The inverse mapped coordinates of all matrices in a
+    # chunk are computed with a single matrix multiplication and
+    # interpolated with a single call to map_coordinates().
+    # Input:
+    # I - image to be transformed, or a SplineImage
+    # Th - N-by-3-by-3 stack of homogeneous transformation matrices
+    # output_shape - size of the output images (default is same size as
+    # input)
+    # chunk_size - number of matrices per chunk, which bounds the
+    # memory used for the coordinates to 3*chunk_size*p values
+    # order - interpolation order, see image_transform()
+    # Output:
+    # It - N-by-H-by-W stack of transformed images
+
+    if output_shape is None:
+        output_shape = I.shape
+
+    Th = np.asarray(Th).reshape(-1, 3, 3)
+    N = Th.shape[0]
+
+    Xh = util.sampling_grid(output_shape[0], output_shape[1], dtype=FLOAT_DTYPE)
+    inverse = np.linalg.inv(Th).astype(FLOAT_DTYPE)
+
+    It = np.empty((N, output_shape[0], output_shape[1]), dtype=I.dtype)
+    data, options = interpolation_input(I, order)
+
+    for k in range(0, N, chunk_size):
+        inverse_k = inverse[k:k+chunk_size]
+
+        # inverse mapped row and column coordinates of all matrices in
+        # the chunk, each as a chunk-by-p matrix
+        coords = np.empty((2, inverse_k.shape[0], Xh.shape[1]), dtype=FLOAT_DTYPE)
+        with util.stage('coordinate_mapping'):
+            np.dot(inverse_k[:,1,:], Xh, out=coords[0])
+            np.dot(inverse_k[:,0,:], Xh, out=coords[1])
+
+        with util.stage('interpolation'):
+            It[k:k+chunk_size] = ndimage.map_coordinates(data, coords, output=I.dtype,
+                **options).reshape((-1, output_shape[0], output_shape[1]))
+
+    return It
+
+
+def image_transform_tiled(I, Th, output_shape=None, tile_shape=256, out=None, order=1):
+    # Image transformation by inverse mapping, one output tile at a
+    # time. Only the coordinates of one tile are in memory at once, and
+    # they are computed from the pixel indices along every axis instead
+    # of from a homogeneous coordinate matrix. This makes it possible to
+    # transform images that are much larger than the available memory
+    # into a memory-mapped output.
+    # Input:
+    # I - image to be transformed (2D image or 3D volume), or a
+    # SplineImage
+    # Th - homogeneous transformation matrix
+    # output_shape - size of the output image (default is same size as
+    # input); it can be smaller (a crop starting at pixel 0) or larger
+    # than the input
+    # tile_shape - size of the tiles, a single value or one value per
+    # dimension
+    # out - optional preallocated output of size output_shape, for
+    # example a np.memmap or np.lib.format.open_memmap() array
+    # order - interpolation order, see image_transform()
+    # Output:
+    # It - transformed image (out if it is given)
+
+    n = I.ndim
+
+    if output_shape is None:
+        output_shape = I.shape
+    output_shape = tuple(output_shape)
+
+    if out is None:
+        out = np.empty(output_shape, dtype=I.dtype)
+    elif out.shape != output_shape:
+        raise AssertionError("The output must have the size output_shape.")
+
+    tile_shape = np.broadcast_to(tile_shape, (n,))
+    data, options = interpolation_input(I, order)
+    inverse = Th.inverse.matrix if isinstance(Th, Transform) else util.inv_h(Th)
+    inverse = inverse.astype(FLOAT_DTYPE)
+
+    starts = [range(0, output_shape[d], tile_shape[d]) for d in range(n)]
+
+    for start in itertools.product(*starts):
+        tile = tuple(slice(start[d], min(start[d]+tile_shape[d], output_shape[d])) for d in range(n))
+
+        # pixel indices along every image axis, shaped to broadcast over
+        # the tile; image axis d is coordinate n-1-d of Th
+        idx = np.ix_(*[np.arange(t.start, t.stop, dtype=FLOAT_DTYPE) for t in tile])
+
+        coords = np.empty((n,) + tuple(t.stop-t.start for t in tile), dtype=FLOAT_DTYPE)
+        with util.stage('coordinate_mapping'):
+            for d in range(n):
+                k = n-1-d
+                coords[d] = inverse[k, n]
+                for e in range(n):
+                    coords[d] += inverse[k, n-1-e]*idx[e]
+
+        with util.stage('interpolation'):
+            out[tile] = ndimage.map_coordinates(data, coords, output=out.dtype, **options)
+
+    return out
+
+
+@util.timed('sampling')
+def sample_pixels(shape, fraction, stratified=False):
+    # Random subset of the pixels (voxels) of an image.
+    # Input:
+    # shape - size of the image (2D or 3D)
+    # fraction - fraction of the pixels to sample (e.g. 0.05)
+    # stratified - if True, the image is divided in blocks of about
+    # 1/fraction pixels (squares for 2D images, cubes for 3D volumes)
+    # and one random pixel is taken from every block, which spreads the
+    # samples evenly over the image
+    # Output:
+    # samples - sorted flat indices of the sampled pixels
+
+    if stratified:
+        step = max(1, int(round(fraction**(-1/len(shape)))))
+        # first pixel of every block along every axis, then a random
+        # offset within the block
+        starts = np.ix_(*[np.arange(0, size, step) for size in shape])
+        blocks = np.broadcast(*starts).shape
+        idx = [np.minimum(s + np.random.randint(step, size=blocks), size-1).ravel()
+               for s, size in zip(starts, shape)]
+        samples = np.ravel_multi_index(idx, shape)
+    else:
+        n = int(np.prod(shape))
+        samples = np.random.choice(n, int(round(fraction*n)), replace=False)
+
+    return np.sort(samples)
+
+
+def mask_transform(Im, Th, mask, samples=None):
+    # Image transformation of only the pixels inside a mask of the fixed
+    # image that are mapped inside the moving image. The other pixels
+    # are neither interpolated nor compared, so the background of the
+    # fixed image and the zeros outside the field of view of the moving
+    # image do not affect the similarity.
+    # Input:
+    # Im - image to be transformed, or a SplineImage
+    # Th - homogeneous transformation matrix (or Transform)
+    # mask - boolean mask with the size of the fixed image
+    # samples - optional flat indices of pixels (see sample_pixels());
+    # only the samples inside the mask are used
+    # Output:
+    # It - column-vector with the values of the used pixels
+    # Xt - inverse mapped homogeneous coordinates of the used pixels
+    # pixels - flat indices of the used pixels in the fixed image
+
+    n = Im.ndim
+    inverse = Th.inverse.matrix if isinstance(Th, Transform) else util.inv_h(Th)
+    inverse = inverse.astype(FLOAT_DTYPE)
+
+    pixels = np.flatnonzero(mask)
+    if samples is not None:
+        pixels = np.intersect1d(pixels, samples, assume_unique=True)
+
+    with util.stage('coordinate_mapping'):
+        Xt = inverse.dot(util.sampling_grid(*mask.shape, dtype=FLOAT_DTYPE)[:, pixels])
+
+    # field of view of the moving image, coordinates in (x, y, ...) order
+    upper = np.array(Im.shape[::-1], dtype=FLOAT_DTYPE).reshape(-1, 1) - 1
+    inside = np.all((Xt[:n] >= 0) & (Xt[:n] <= upper), axis=0)
+    pixels = pixels[inside]
+    Xt = Xt[:, inside]
+
+    data, options = interpolation_input(Im)
+    with util.stage('interpolation'):
+        It = ndimage.map_coordinates(data, Xt[n-1::-1], output=Im.dtype, **options).reshape(-1, 1)
+
+    return It, Xt, pixels
+
+
+def resampling_operator(Th, input_shape, output_shape=None, nearest=False):
+    # Sparse matrix that performs an image transformation by inverse
+    # mapping with linear (or nearest-neighbour) interpolation, as
+    # image_transform(). The coordinates and interpolation weights are
+    # computed once; every image of size input_shape can then be
+    # transformed with one sparse matrix product, see resample().
+    # Input:
+    # Th - homogeneous transformation matrix (or Transform)
+    # input_shape - size of the images to transform (2D or 3D)
+    # output_shape - size of the transformed images (default is same
+    # size as input)
+    # nearest - nearest-neighbour interpolation (for label images)
+    # instead of linear interpolation
+    # Output:
+    # W - p_out-by-p_in sparse matrix (CSR) with the interpolation
+    # weights, where p_in and p_out are the numbers of pixels of the
+    # input and output images; the rows of the pixels that are mapped
+    # outside the input image are empty
+
+    if output_shape is None:
+        output_shape = input_shape
+
+    n = len(input_shape)
+    p_in = int(np.prod(input_shape))
+    inverse = Th.inverse.matrix if isinstance(Th, Transform) else util.inv_h(Th)
+
+    # coordinates in image axis order
+    Xt = inverse.dot(util.sampling_grid(*output_shape))[n-1::-1]
+    p_out = Xt.shape[1]
+
+    size = np.array(input_shape).reshape(-1, 1)
+    rows = np.flatnonzero(np.all((Xt >= 0) & (Xt <= size-1), axis=0))
+    Xt = Xt[:, rows]
+
+    if nearest:
+        cols = np.ravel_multi_index(np.floor(Xt + 0.5).astype(int), input_shape)
+        return sparse.csr_matrix((np.ones(rows.size), (rows, cols)), shape=(p_out, p_in))
+
+    # lower corner of the cell of every point (the last cell for points
+    # on the upper edge) and the position within the cell
+    lower = np.clip(np.floor(Xt), 0, np.maximum(size-2, 0)).astype(int)
+    frac = Xt - lower
+
+    # one weight per corner of the cell
+    data = []
+    cols = []
+    for corner in itertools.product((0, 1), repeat=n):
+        c = np.array(corner).reshape(-1, 1)
+        data.append(np.prod(np.where(c, frac, 1-frac), axis=0))
+        cols.append(np.ravel_multi_index(np.minimum(lower + c, size-1), input_shape))
+
+    W = sparse.csr_matrix((np.concatenate(data), (np.tile(rows, 2**n), np.concatenate(cols))),
+                          shape=(p_out, p_in))
+    W.eliminate_zeros()
+
+    return W
+
+
+def resample(W, images, output_shape):
+    # Transform images with a resampling operator.
+    # Input:
+    # W - output of resampling_operator()
+    # images - image of size input_shape, or a stack of images
+    # (channels) along the first axis
+    # output_shape - size of the transformed images
+    # Output:
+    # It - transformed image(s) with the type of the input; integer
+    # images are rounded, like map_coordinates() does
+
+    images = np.asarray(images)
+    p_in = W.shape[1]
+
+    # all channels as the columns of one matrix
+    It = (W @ images.reshape(-1, p_in).T).T
+
+    # the input and output images have the same number of dimensions,
+    # so a stack has one more (also a stack of a single channel)
+    if images.ndim == len(output_shape):
+        It = It.reshape(tuple(output_shape))
+    else:
+        It = It.reshape((-1,) + tuple(output_shape))
+
+    if np.issubdtype(images.dtype, np.integer):
+        It = np.floor(It + 0.5)
+
+    return It.astype(images.dtype)
+
+
 def ls_solve(A, b):
     # Least-squares solution to a linear system of equations.
     # Input:
@@ -148,7 +665,8 @@ def ls_solve(A, b):
     #------------------------------------------------------------------#
 
     # compute the error
-    E = np.transpose(A.dot(w) - b).dot(A.dot(w) - b)
+    r = A.dot(w) - b
+    E = np.transpose(r).dot(r)
 
     return w, E
 
@@ -167,53 +685,160 @@ def ls_affine(X, Xm):
     # TODO: Implement least-squares fitting of an affine transformation.
     # Use the ls_solve() function that you have previously implemented.
 
-    b = np.transpose(X)
-    b_1 = b[:,0]
-    b_2 = b[:,1]
+    # both coordinates are solved at once: the columns of b are the x
+    # and y coordinates of the fixed points
+    b = np.transpose(X)[:,:2]
 
-    T_1, _ = ls_solve(A,b_1)
-    T_2, _ = ls_solve(A,b_2)
+    W, _ = ls_solve(A, b)
 
-    print("T_1 =" + str(T_1))
-    # T = np.eye(3) #np.eye(len(X))
-    # T[0,:] = T_1
-    # T[1,:] = T_2
+    # Transformation Matrix
+    T = np.array([W[:,0], W[:,1], [0, 0, 1]])
+    #------------------------------------------------------------------#
 
-    # Errors from solving Ax=b1 and Ax=b2
+    return T
 
-    _, E1 = ls_solve(A, b_1)
-    _, E2 = ls_solve(A, b_2)
 
-    # The sum of the errors // Total error
-    E = E1+E2
+def ls_affine_batch(X, Xm, weights=None):
+    # Least-squares fitting of affine transformations to many sets of
+    # corresponding points at once. The normal equations of all sets are
+    # stacked and solved with one call to np.linalg.solve().
+    # Input:
+    # X - Points in the fixed images, N x 3 x n array of homogeneous
+    # coordinates (N point sets of n points)
+    # Xm - Corresponding points in the moving images, N x 3 x n
+    # weights - optional N x n (or n) weights of the points, for example
+    # 0/1 to use only a subset of the points of every set
+    # Output:
+    # T - N x 3 x 3 affine transformations in homogeneous form
+    # E - squared error of every set
 
-    # Transformation Matrix
+    X = np.asarray(X, dtype=float)
+    Xm = np.asarray(Xm, dtype=float)
 
-    T = np.array([T_1, T_2, [0, 0, 1]])
+    if X.shape != Xm.shape or X.ndim != 3 or X.shape[1] != 3:
+        raise AssertionError("The point sets must be N x 3 x n arrays of the same size.")
 
-    # Computing the Affine Error
+    A = np.swapaxes(Xm, 1, 2)
+    b = np.swapaxes(X[:,:2,:], 1, 2)
 
-    Affine_error_list = []
-    Affine_error_T = np.transpose(T.dot(Xm) - X).dot(T.dot(Xm) - X)
+    if weights is None:
+        weights = np.ones(X[:,0,:].shape)
+    weights = np.broadcast_to(weights, X[:,0,:].shape)[:,:,None]
+    AW = A*weights
 
-    for k in range(len(Affine_error_T)):
-        min_val = min(abs(i) for i in Affine_error_T[k])
-        Affine_error_list.append(min_val)
+    # normal equations A'WA w = A'Wb for every set
+    W = np.linalg.solve(np.swapaxes(AW, 1, 2) @ A, np.swapaxes(AW, 1, 2) @ b)
 
-    Affine_error = min(Affine_error_list)
+    T = np.zeros((X.shape[0], 3, 3))
+    T[:,:2,:] = np.swapaxes(W, 1, 2)
+    T[:,2,2] = 1
 
-    #Printing the error on the screen
+    r = A @ W - b
+    E = np.sum(weights*r**2, axis=(1, 2))
 
-    print("The Error = " + str(E))
-    print("The Affine Error = " + str(Affine_error))
-    #------------------------------------------------------------------#
+    return T, E
 
-    return T
+
+def ls_affine_ransac(X, Xm, threshold=2.0, num_hypotheses=500, seed=None):
+    # Robust fitting of an affine transformation with RANSAC. Affine
+    # transformations are fitted exactly to random triplets of
+    # corresponding points, all at once, and the one that agrees with
+    # the largest number of points (inliers) is refitted with least
+    # squares to its inliers. This tolerates wrong correspondences.
+    # Input:
+    # X - Points in the fixed image (homogeneous coordinates)
+    # Xm - Corresponding points in the moving image
+    # threshold - distance in pixels below which a transformed point
+    # is an inlier
+    # num_hypotheses - number of random triplets
+    # seed - seed of the random number generator
+    # Output:
+    # T - affine transformation in homogeneous form
+    # inliers - boolean vector of the points used for the final fit
+
+    X = np.asarray(X, dtype=float)
+    Xm = np.asarray(Xm, dtype=float)
+    n = X.shape[1]
+
+    if n < 3:
+        raise AssertionError("At least three corresponding points are needed.")
+
+    rng = np.random.default_rng(seed)
+
+    # random triplets of distinct points
+    idx = np.argsort(rng.random((num_hypotheses, n)), axis=1)[:,:3]
+
+    # exact fit A w = b for every triplet, skipping collinear triplets
+    A = np.swapaxes(Xm[:,idx], 0, 1).transpose(0, 2, 1)
+    b = np.swapaxes(X[:2,idx], 0, 1).transpose(0, 2, 1)
+    valid = np.abs(np.linalg.det(A)) > 1e-9
+    if not np.any(valid):
+        raise AssertionError("All point triplets are collinear.")
+    W = np.linalg.solve(A[valid], b[valid])
+
+    # count the inliers of every hypothesis
+    d = np.linalg.norm(np.swapaxes(W, 1, 2) @ Xm - X[:2], axis=1)
+    num_inliers = np.sum(d < threshold, axis=1)
+    best = np.argmax(num_inliers)
+    inliers = d[best] < threshold
+
+    if np.sum(inliers) < 3:
+        inliers = np.zeros(n, dtype=bool)
+        inliers[idx[valid][best]] = True
+
+    T = ls_affine(X[:,inliers], Xm[:,inliers])
+
+    return T, inliers
 
 
 # SECTION 3. Image simmilarity metrics
 
 
+def correlation_metric(I):
+    # Normalized cross-correlation with a fixed image. The zero-mean,
+    # unit-norm vector of the fixed image is computed once, so every
+    # evaluation only needs the sum, the sum of squares and the dot
+    # product with the fixed image of the second image.
+    # Input:
+    # I - fixed image
+    # Output:
+    # ncc - function with inputs (J, gradient=False) that returns the
+    #       normalized cross-correlation between I and J, and if
+    #       gradient is True also its derivative w.r.t. every pixel of J
+
+    dtype = FLOAT_DTYPE
+
+    u = I.reshape(-1).astype(dtype)
+    u = u - u.mean()
+    u = u / np.sqrt(u.dot(u))
+    n = u.size
+
+    @util.timed('correlation')
+    def ncc(J, gradient=False):
+        if J.size != n:
+            raise AssertionError("The inputs must be the same size.")
+
+        v = np.asarray(J, dtype=dtype).reshape(-1)
+
+        # norm of v-mean(v) without computing v-mean(v)
+        v_sum = v.sum()
+        norm_v = np.sqrt(v.dot(v) - v_sum*v_sum/n)
+
+        # u has zero mean, so u.(v-mean(v)) = u.v
+        CC = u.dot(v) / norm_v
+
+        if not gradient:
+            return CC
+
+        # both terms have zero mean, so the derivative of the mean
+        # subtraction does not have to be accounted for separately
+        dCC = (u - CC*(v - v_sum/n)/norm_v) / norm_v
+
+        return CC, dCC.reshape(J.shape)
+
+    return ncc
+
+
 def correlation(I, J):
     # Compute the normalized cross-correlation between two images.
     # Input:
@@ -225,64 +850,55 @@ def correlation(I, J):
     if I.shape != J.shape:
         raise AssertionError("The inputs must be the same size.")
 
-    u = I.reshape((I.shape[0]*I.shape[1],1))
-    v = J.reshape((J.shape[0]*J.shape[1],1))
-
-    # subtract the mean
-    u = u - u.mean(keepdims=True)
-    v = v - v.mean(keepdims=True)
-
     #------------------------------------------------------------------#
     # TODO: Implement the computation of the normalized cross-correlation.
     # This can be done with a single line of code, but you can use for-loops instead.
-    uT = np.transpose(u)
-    vT = np.transpose(v)
-
-    CC = (uT.dot(v))/(np.sqrt(uT.dot(u))*np.sqrt(vT.dot(v)))
+    CC = correlation_metric(I)(J)
     #------------------------------------------------------------------#
 
     return CC
 
 
+@util.timed('histogram')
 def joint_histogram(I, J, num_bins=16, minmax_range=None):
     # Compute the joint histogram of two signals.
     # Input:
     # I, J - input images
     # num_bins: number of bins of the joint histogram (default: 16)
     # range - range of the values of the signals (defaul: min and max
-    # of the inputs)
+    # of the inputs); values outside the range (e.g. from spline
+    # overshoot) are counted in the first or last bin
     # Output:
     # p - joint histogram
 
     if I.shape != J.shape:
         raise AssertionError("The inputs must be the same size.")
 
-    # make sure the inputs are column-vectors of type double (highest
-    # precision)
-    I = I.reshape((I.shape[0]*I.shape[1],1)).astype(float)
-    J = J.reshape((J.shape[0]*J.shape[1],1)).astype(float)
+    # make sure the inputs are floating point vectors (double
+    # precision unless set_float_dtype() selected single precision)
+    I = I.reshape(-1).astype(FLOAT_DTYPE)
+    J = J.reshape(-1).astype(FLOAT_DTYPE)
 
     # if the range is not specified use the min and max values of the
     # inputs
     if minmax_range is None:
-        minmax_range = np.array([min(min(I),min(J)), max(max(I),max(J))])
+        minmax_range = np.array([min(I.min(), J.min()), max(I.max(), J.max())])
+    minmax_range = np.asarray(minmax_range, dtype=FLOAT_DTYPE)
 
     # this will normalize the inputs to the [0 1] range
     I = (I-minmax_range[0]) / (minmax_range[1]-minmax_range[0])
     J = (J-minmax_range[0]) / (minmax_range[1]-minmax_range[0])
 
     # and this will make them integers in the [0 (num_bins-1)] range
-    I = np.round(I*(num_bins-1)).astype(int)
-    J = np.round(J*(num_bins-1)).astype(int)
+    I = np.clip(np.round(I*(num_bins-1)).astype(int), 0, num_bins-1)
+    J = np.clip(np.round(J*(num_bins-1)).astype(int), 0, num_bins-1)
 
     n = I.shape[0]
-    hist_size = np.array([num_bins,num_bins])
-
-    # initialize the joint histogram to all zeros
-    p = np.zeros(hist_size)
 
-    for k in range(n):
-        p[I[k], J[k]] = p[I[k], J[k]] + 1
+    # count the cooccuring intensities in one pass: every pair of bin
+    # indices is mapped to a single index in the raveled histogram
+    p = np.bincount(I*num_bins + J, minlength=num_bins*num_bins)
+    p = p.reshape((num_bins, num_bins)).astype(float)
 
     #------------------------------------------------------------------#
     # TODO: At this point, p contains the counts of cooccuring
@@ -295,6 +911,7 @@ def joint_histogram(I, J, num_bins=16, minmax_range=None):
     return p
 
 
+@util.timed('mutual_information')
 def mutual_information(p):
     # Compute the mutual information from a joint histogram.
     # Input:
@@ -371,15 +988,151 @@ def mutual_information_e(p):
     return MI
 
 
+def mutual_information_metric(I, num_bins=16, minmax_range=None):
+    # Mutual information with a fixed image. The bin indices and the
+    # marginal entropy term of the fixed image are computed once, so
+    # every evaluation only bins the second image and counts the joint
+    # histogram. The result equals mutual_information(joint_histogram(
+    # I, J, num_bins, minmax_range)), also when the function is called
+    # from several threads at the same time (e.g. by ngradient()).
+    # Input:
+    # I - fixed image
+    # num_bins - number of bins of the joint histogram (default: 16)
+    # minmax_range - range of the values of the signals; if it is given
+    # (e.g. [0, 255]) no min/max scan of the images is needed (default:
+    # min and max of both inputs, as in joint_histogram())
+    # Output:
+    # mi - function with inputs (J, gradient=False) that returns the
+    #      mutual information between I and J, and if gradient is True
+    #      also its derivative w.r.t. every pixel of J (see
+    #      mutual_information_agrad())
+
+    EPSILON = 10e-10
+
+    dtype = FLOAT_DTYPE
+
+    u = I.reshape(-1).astype(dtype)
+    n = u.size
+    I_range = np.array([u.min(), u.max()]) if minmax_range is None else np.asarray(minmax_range, dtype=dtype)
+
+    def quantize(rng):
+        # bin indices of I (multiplied by num_bins to index the raveled
+        # joint histogram) and the marginal entropy term of I
+        a = np.clip(np.round((u-rng[0]) / (rng[1]-rng[0]) * (num_bins-1)).astype(int), 0, num_bins-1)
+        p_I = np.bincount(a, minlength=num_bins)/n + num_bins*EPSILON
+        return a*num_bins, a, np.sum(p_I*np.log(p_I))
+
+    # the range and the bins of I are replaced together in a single
+    # assignment, so concurrent calls never combine the bins of one
+    # range with another range
+    fixed = {'state': (I_range, quantize(I_range))}
+
+    @util.timed('mutual_information')
+    def mi(J, gradient=False):
+        if J.size != n:
+            raise AssertionError("The inputs must be the same size.")
+
+        v = np.asarray(J, dtype=dtype).reshape(-1)
+
+        rng, bins = fixed['state']
+        if minmax_range is None:
+            # the range of both images; I only has to be quantized again
+            # if J extends the range of I
+            J_rng = np.array([min(I_range[0], v.min()), max(I_range[1], v.max())], dtype=dtype)
+            if not np.array_equal(J_rng, rng):
+                rng, bins = J_rng, quantize(J_rng)
+                fixed['state'] = (rng, bins)
+
+        a_raveled, a, H_I = bins
+
+        # values outside a given minmax_range are counted in the first
+        # or last bin, as in joint_histogram()
+        bin_scale = (num_bins-1) / (rng[1]-rng[0])
+        b = np.clip((v-rng[0])*bin_scale, 0, num_bins-1)
+
+        with util.stage('histogram'):
+            p = np.bincount(a_raveled + np.round(b).astype(int), minlength=num_bins*num_bins)
+        p = p.reshape((num_bins, num_bins))/n + EPSILON
+        p_J = np.sum(p, axis=0)
+
+        # MI = sum(p*log(p/(p_I*p_J))), written as a sum of entropy terms
+        MI = np.sum(p*np.log(p)) - H_I - np.sum(p_J*np.log(p_J))
+
+        if not gradient:
+            return MI
+
+        # lower of the two bins that the kernel of every pixel overlaps
+        b0 = np.clip(np.floor(b).astype(int), 0, num_bins-2)
+        L = np.log(p / p_J)
+
+        dMI = (L[a, b0+1] - L[a, b0]) * bin_scale / n
+
+        return MI, dMI.reshape(J.shape)
+
+    return mi
+
+
 # SECTION 4. Towards intensity-based image registration
 
 
-def ngradient(fun, x, h=1e-3):
+@contextmanager
+def parallel_map(executor=None, num_workers=None):
+    # Map function of an executor, for the parallel evaluations of
+    # ngradient(), register() and multi_start_register(). A new pool is
+    # shut down at the end of the with block.
+    # Input:
+    # executor - None to evaluate serially, 'thread' or 'process' for a
+    #            new thread or process pool, or an existing
+    #            concurrent.futures executor
+    # num_workers - number of workers of a new pool (default: number of
+    #               processors)
+    # Output:
+    # pool - the executor, or None to evaluate serially
+    # map_fun - map() or the map method of the executor
+
+    if executor is None:
+        yield None, map
+    elif isinstance(executor, Executor):
+        yield executor, executor.map
+    elif executor in ('thread', 'process'):
+        pool = ThreadPoolExecutor if executor == 'thread' else ProcessPoolExecutor
+        with pool(max_workers=num_workers) as pool:
+            yield pool, pool.map
+    else:
+        raise AssertionError("Unknown executor: " + str(executor))
+
+
+def first_output(fun, x):
+    # Value of a function that optionally returns extra outputs (such
+    # as the transformed image) after the value.
+    # Input:
+    # fun - function
+    # x - input of the function
+    # Output:
+    # f - first output of fun(x)
+
+    f = fun(x)
+    if isinstance(f, tuple):
+        f = f[0]
+
+    return f
+
+
+@util.timed('ngradient')
+def ngradient(fun, x, h=1e-3, executor=None, num_workers=None):
     # Computes the derivative of a function with numerical differentiation.
     # Input:
     # fun - function for which the gradient is computed
     # x - vector of parameter values at which to compute the gradient
     # h - a small positive number used in the finite difference formula
+    # executor - None to evaluate the function serially, 'thread' or
+    #            'process' to evaluate all 2*len(x) perturbations in a
+    #            new thread or process pool, or an existing
+    #            concurrent.futures executor (avoids starting a pool
+    #            for every gradient). For processes fun must be
+    #            picklable, so no lambda functions (use functools.partial).
+    # num_workers - number of workers of a new pool (default: number of
+    #               processors)
     # Output:
     # g - vector of partial derivatives (gradient) of fun
 
@@ -397,25 +1150,32 @@ def ngradient(fun, x, h=1e-3):
     #     g.append(d_dx)
     #     print(g)
 
-    g = np.zeros_like(x)
-
+    # all perturbed parameter vectors: x+h/2 and x-h/2 for every parameter
+    X = []
     for k in range(np.size(x)):
         x1 = np.copy(x)
         x2 = np.copy(x)
         x1[k] = x1[k] + (h/2)
         x2[k] = x2[k] - (h/2)
-        fun1 = fun(x1)
-        fun2 = fun(x2)
-        if isinstance(fun1, tuple):
-            fun1 = fun1[0]
-            fun2 = fun2[0]
-        g[k] = ((fun1-fun2)/h)
+        X.extend([x1, x2])
+
+    fun = partial(first_output, fun)
+
+    with parallel_map(executor, num_workers) as (_, map_fun):
+        F = list(map_fun(fun, X))
+
+    g = np.zeros_like(x)
+
+    # the similarity functions return scalars, but other functions can
+    # return 1-element arrays (such as [f] or [[f]]), which are squeezed
+    for k in range(np.size(x)):
+        g[k] = np.squeeze((F[2*k]-F[2*k+1])/h)
     #------------------------------------------------------------------#
 
     return g
 
 
-def rigid_corr(I, Im, x):
+def rigid_corr(I, Im, x, samples=None, metric=None, mask=None):
     # Computes normalized cross-correlation between a fixed and
     # a moving image transformed with a rigid transformation.
     # Input:
@@ -424,16 +1184,25 @@ def rigid_corr(I, Im, x):
     # x - parameters of the rigid transform: the first element
     #     is the rotation angle and the remaining two elements
     #     are the translation
+    # samples - optional flat indices of the pixels (see
+    #     sample_pixels()); only these pixels are transformed and
+    #     compared and Im_t is a column-vector with their values
+    # metric - optional correlation_metric(I), which avoids recomputing
+    #     the statistics of the fixed image (not used with samples or
+    #     mask)
+    # mask - optional boolean mask of the fixed image; only the pixels
+    #     inside the mask that are mapped inside the moving image are
+    #     transformed and compared (see mask_transform()) and Im_t is a
+    #     column-vector with their values
     # Output:
     # C - normalized cross-correlation between I and T(Im)
     # Im_t - transformed moving image T(Im)
+    # Th - homogeneous transformation matrix
 
     SCALING = 100
 
-    # the first element is the rotation angle
-    T = rotate(x[0])
-
-    # the remaining two element are the translation
+    # the first element is the rotation angle and the remaining two
+    # element are the translation
     #
     # the gradient ascent/descent method work best when all parameters
     # of the function have approximately the same range of values
@@ -442,19 +1211,28 @@ def rigid_corr(I, Im, x):
     # values compared to the translation vector this is why we pass a
     # scaled down version of the translation vector to this function
     # and then scale it up when computing the transformation matrix
-    Th = util.t2h(T, x[1:]*SCALING)
+    Th = rigid_matrix(x, SCALING)
 
     # transform the moving image
-    Im_t, Xt = image_transform(Im, Th)
+    if mask is not None:
+        Im_t, Xt, pixels = mask_transform(Im, Th, mask, samples)
+        I = I.reshape(-1, 1)[pixels]
+    else:
+        Im_t, Xt = image_transform(Im, Th, samples=samples)
+        if samples is not None:
+            I = I.reshape(-1, 1)[samples]
 
     # compute the similarity between the fixed and transformed
     # moving image
-    C = correlation(I, Im_t)
+    if metric is not None and samples is None and mask is None:
+        C = metric(Im_t)
+    else:
+        C = correlation(I, Im_t)
 
     return C, Im_t, Th
 
 
-def affine_corr(I, Im, x):
+def affine_corr(I, Im, x, samples=None, metric=None, mask=None):
     # Computes normalized cross-corrleation between a fixed and
     # a moving image transformed with an affine transformation.
     # Input:
@@ -465,9 +1243,13 @@ def affine_corr(I, Im, x):
     #     scaling parameters, the fourth and fifth are the
     #     shearing parameters and the remaining two elements
     #     are the translation
+    # samples - optional flat indices of the pixels, see rigid_corr()
+    # metric - optional correlation_metric(I), see rigid_corr()
+    # mask - optional boolean mask of the fixed image, see rigid_corr()
     # Output:
     # C - normalized cross-corrleation between I and T(Im)
     # Im_t - transformed moving image T(Im)
+    # Th - homogeneous transformation matrix
 
     NUM_BINS = 64
     SCALING = 100
@@ -475,22 +1257,27 @@ def affine_corr(I, Im, x):
     #------------------------------------------------------------------#
     # TODO: Implement the missing functionality
 
-    T_rot = rotate(x[0])
-    T_scale = scale(x[1], x[2])
-    T_shear = shear(x[3], x[4])
-    T = T_rot.dot(T_scale.dot(T_shear))
-
-    Th = util.t2h(T, x[5:] * SCALING)
-
-    Im_t, Xt = image_transform(Im, Th)
-
-    C = correlation(I, Im_t)
+    # rotation, scaling and shearing in closed form
+    Th = affine_matrix(x, SCALING)
+
+    if mask is not None:
+        Im_t, Xt, pixels = mask_transform(Im, Th, mask, samples)
+        I = I.reshape(-1, 1)[pixels]
+    else:
+        Im_t, Xt = image_transform(Im, Th, samples=samples)
+        if samples is not None:
+            I = I.reshape(-1, 1)[samples]
+
+    if metric is not None and samples is None and mask is None:
+        C = metric(Im_t)
+    else:
+        C = correlation(I, Im_t)
     #------------------------------------------------------------------#
 
     return C, Im_t, Th
 
 
-def affine_mi(I, Im, x):
+def affine_mi(I, Im, x, samples=None, metric=None, mask=None):
     # Computes mutual information between a fixed and
     # a moving image transformed with an affine transformation.
     # Input:
@@ -501,9 +1288,15 @@ def affine_mi(I, Im, x):
     #     scaling parameters, the fourth and fifth are the
     #     shearing parameters and the remaining two elements
     #     are the translation
+    # samples - optional flat indices of the pixels, see rigid_corr()
+    # metric - optional mutual_information_metric(I, 64), which avoids
+    #     quantizing the fixed image in every evaluation (not used with
+    #     samples or mask)
+    # mask - optional boolean mask of the fixed image, see rigid_corr()
     # Output:
     # MI - mutual information between I and T(Im)
     # Im_t - transformed moving image T(Im)
+    # Th - homogeneous transformation matrix
 
     NUM_BINS = 64
     SCALING = 100
@@ -511,22 +1304,1468 @@ def affine_mi(I, Im, x):
     #------------------------------------------------------------------#
     # TODO: Implement the missing functionality
 
-    T_rot = rotate(x[0])
-    T_scale = scale(x[1], x[2])
-    T_shear = shear(x[3], x[4])
-
     # Transformation
 
-    T = T_rot.dot(T_scale.dot(T_shear))  # Total affine transformation matrix
+    Th = affine_matrix(x, SCALING)  # Transformation matrix homogeneous
 
-    Th = util.t2h(T, x[5:] * SCALING)  # Transformation matrix homogeneous
+    if mask is not None:
+        Im_t, Xt, pixels = mask_transform(Im, Th, mask, samples)
+        I = I.reshape(-1, 1)[pixels]
+    else:
+        Im_t, Xt = image_transform(Im, Th, samples=samples)  # Transforming image Im to Im_t
+        if samples is not None:
+            I = I.reshape(-1, 1)[samples]
 
-    Im_t, Xt = image_transform(Im, Th)  # Transforming image Im to Im_t
-
-    p = joint_histogram(I, Im_t, NUM_BINS)  # Probability mass function
-    MI = mutual_information(p)  # Mutual information between Image I and transformed image
+    if metric is not None and samples is None and mask is None:
+        MI = metric(Im_t)
+    else:
+        p = joint_histogram(I, Im_t, NUM_BINS)  # Probability mass function
+        MI = mutual_information(p)  # Mutual information between Image I and transformed image
 
     #------------------------------------------------------------------#
 
 
     return MI, Im_t, Th
+
+
+def rigid_mi(I, Im, x, samples=None, metric=None, mask=None):
+    # Computes mutual information between a fixed and
+    # a moving image transformed with a rigid transformation.
+    # Input:
+    # I - fixed image
+    # Im - moving image
+    # x - parameters of the rigid transform: the first element
+    #     is the rotation angle and the remaining two elements
+    #     are the translation
+    # samples - optional flat indices of the pixels, see rigid_corr()
+    # metric - optional mutual_information_metric(I, 64), which avoids
+    #     quantizing the fixed image in every evaluation (not used with
+    #     samples or mask)
+    # mask - optional boolean mask of the fixed image, see rigid_corr()
+    # Output:
+    # MI - mutual information between I and T(Im)
+    # Im_t - transformed moving image T(Im)
+    # Th - homogeneous transformation matrix
+
+    NUM_BINS = 64
+    SCALING = 100
+
+    Th = rigid_matrix(x, SCALING)
+
+    if mask is not None:
+        Im_t, Xt, pixels = mask_transform(Im, Th, mask, samples)
+        I = I.reshape(-1, 1)[pixels]
+    else:
+        Im_t, Xt = image_transform(Im, Th, samples=samples)
+        if samples is not None:
+            I = I.reshape(-1, 1)[samples]
+
+    if metric is not None and samples is None and mask is None:
+        MI = metric(Im_t)
+    else:
+        p = joint_histogram(I, Im_t, NUM_BINS)
+        MI = mutual_information(p)
+
+    return MI, Im_t, Th
+
+
+# SECTION 5. Intensity-based registration with analytic gradients
+
+
+def correlation_agrad(I, J):
+    # Normalized cross-correlation and its derivative with respect to
+    # the intensities of the second image.
+    # Input:
+    # I, J - input images
+    # Output:
+    # CC - normalized cross-correlation
+    # dCC - derivative of CC w.r.t. every pixel of J (same size as J)
+
+    if I.shape != J.shape:
+        raise AssertionError("The inputs must be the same size.")
+
+    CC, dCC = correlation_metric(I)(J, gradient=True)
+
+    return CC, dCC
+
+
+def mutual_information_agrad(I, J, num_bins=16, minmax_range=None):
+    # Mutual information and its derivative with respect to the
+    # intensities of the second image.
+    # The value is computed from the joint histogram exactly as in
+    # joint_histogram() and mutual_information(). For the derivative the
+    # contribution of every pixel of J is spread over its two nearest
+    # bins with a linear kernel (partial volume), which makes the
+    # p.m.f. differentiable. The marginal p.m.f. of I does not depend
+    # on J, so dMI = sum(dp*log(p/p_J)).
+    # Input:
+    # I, J - input images
+    # num_bins - number of bins of the joint histogram (default: 16)
+    # minmax_range - range of the values of the signals (default: min
+    # and max of the inputs)
+    # Output:
+    # MI - mutual information in nat units
+    # dMI - derivative of MI w.r.t. every pixel of J (same size as J)
+
+    if I.shape != J.shape:
+        raise AssertionError("The inputs must be the same size.")
+
+    MI, dMI = mutual_information_metric(I, num_bins, minmax_range)(J, gradient=True)
+
+    return MI, dMI
+
+
+def image_gradient(Im):
+    # Spatial gradient of a moving image, for transform_agrad(). It does
+    # not depend on the transformation, so a registration can compute
+    # it once and pass it to every evaluation of the similarity.
+    # Input:
+    # Im - moving image (or SplineImage, of which the original image is
+    #      used)
+    # Output:
+    # gradients - derivatives (Gy, Gx) along the rows and the columns
+
+    return tuple(np.gradient(np.asarray(Im).astype(FLOAT_DTYPE)))
+
+
+@util.timed('transform_gradient')
+def transform_agrad(dS, Im, Xt, T, dT, scaling, gradients=None):
+    # Chain rule from the derivative of a similarity metric w.r.t. the
+    # transformed moving image to the derivative w.r.t. the parameters
+    # of a transformation Th = [T, t*scaling; 0, 0, 1], where the
+    # transformed image is Im_t(X) = Im(inv(Th)X).
+    # Input:
+    # dS - derivative of the similarity w.r.t. every pixel of Im_t
+    # Im - moving image
+    # Xt - inverse mapped coordinates returned by image_transform()
+    # T - 2D transformation matrix
+    # dT - list of derivatives of T w.r.t. its parameters
+    # scaling - scaling factor of the translation parameters
+    # gradients - optional image_gradient(Im); computed here if not given
+    # Output:
+    # g - gradient w.r.t. the parameters in dT followed by the two
+    #     translation parameters
+
+    # spatial gradient of the moving image sampled at the inverse
+    # mapped coordinates (of the original image for a SplineImage)
+    Gy, Gx = image_gradient(Im) if gradients is None else gradients
+    coords = [Xt[1,:], Xt[0,:]]
+    Gx = ndimage.map_coordinates(Gx, coords, order=1, mode='constant')
+    Gy = ndimage.map_coordinates(Gy, coords, order=1, mode='constant')
+
+    dS = dS.reshape(-1)
+    V = np.array([dS*Gx, dS*Gy])
+
+    # d(Xt)/d(T_k) = -inv(T)*dT_k*Xt and d(Xt)/d(t) = -inv(T), so
+    # every derivative only needs the sums of V and V*Xt'
+    inverse_T = np.linalg.inv(T)
+    G = inverse_T.T.dot(V.dot(Xt[:2,:].T))
+    s = inverse_T.T.dot(V.sum(axis=1))
+
+    g = np.zeros(len(dT) + 2)
+    for k in range(len(dT)):
+        g[k] = -np.sum(G*dT[k])
+    g[len(dT):] = -s*scaling
+
+    return g
+
+
+def affine_derivatives(x):
+    # 2D affine transformation matrix T = R*S*Sh and its derivatives
+    # w.r.t. the rotation, scaling and shearing parameters.
+    # Input:
+    # x - the first five parameters of affine_corr()/affine_mi()
+    # Output:
+    # T - transformation matrix
+    # dT - list with the five derivatives of T
+
+    T_rot = rotate(x[0])
+    T_scale = scale(x[1], x[2])
+    T_shear = shear(x[3], x[4])
+
+    c = np.cos(x[0])
+    s = np.sin(x[0])
+    dT_rot = np.array([[-s,-c],[c,-s]])
+
+    T = T_rot.dot(T_scale.dot(T_shear))
+
+    dT = [dT_rot.dot(T_scale.dot(T_shear)),
+          T_rot.dot(np.array([[1,0],[0,0]]).dot(T_shear)),
+          T_rot.dot(np.array([[0,0],[0,1]]).dot(T_shear)),
+          T_rot.dot(T_scale.dot(np.array([[0,1],[0,0]]))),
+          T_rot.dot(T_scale.dot(np.array([[0,0],[1,0]])))]
+
+    return T, dT
+
+
+def rigid_corr_agrad(I, Im, x, samples=None, metric=None, mask=None, gradients=None):
+    # Same as rigid_corr() but also returns the analytic gradient of
+    # the normalized cross-correlation w.r.t. the parameters, so an
+    # optimization step needs a single image transformation.
+    # metric - optional correlation_metric(I), see rigid_corr()
+    # mask - optional boolean mask of the fixed image, see rigid_corr()
+    # gradients - optional image_gradient(Im), see transform_agrad()
+    # Output:
+    # C - normalized cross-correlation between I and T(Im)
+    # Im_t - transformed moving image T(Im)
+    # Th - homogeneous transformation matrix
+    # g - gradient of C w.r.t. x
+
+    SCALING = 100
+
+    T = rotate(x[0])
+    c = np.cos(x[0])
+    s = np.sin(x[0])
+    dT = [np.array([[-s,-c],[c,-s]])]
+
+    Th = util.t2h(T, x[1:]*SCALING)
+
+    if mask is not None:
+        Im_t, Xt, pixels = mask_transform(Im, Th, mask, samples)
+        I = I.reshape(-1, 1)[pixels]
+    else:
+        Im_t, Xt = image_transform(Im, Th, samples=samples)
+        if samples is not None:
+            I = I.reshape(-1, 1)[samples]
+
+    if metric is not None and samples is None and mask is None:
+        C, dC = metric(Im_t, gradient=True)
+    else:
+        C, dC = correlation_agrad(I, Im_t)
+    g = transform_agrad(dC, Im, Xt, T, dT, SCALING, gradients)
+
+    return C, Im_t, Th, g
+
+
+def affine_corr_agrad(I, Im, x, samples=None, metric=None, mask=None, gradients=None):
+    # Same as affine_corr() but also returns the analytic gradient of
+    # the normalized cross-correlation w.r.t. the parameters.
+    # metric - optional correlation_metric(I), see rigid_corr()
+    # mask - optional boolean mask of the fixed image, see rigid_corr()
+    # gradients - optional image_gradient(Im), see transform_agrad()
+    # Output:
+    # C - normalized cross-correlation between I and T(Im)
+    # Im_t - transformed moving image T(Im)
+    # Th - homogeneous transformation matrix
+    # g - gradient of C w.r.t. x
+
+    SCALING = 100
+
+    T, dT = affine_derivatives(x)
+    Th = util.t2h(T, x[5:]*SCALING)
+
+    if mask is not None:
+        Im_t, Xt, pixels = mask_transform(Im, Th, mask, samples)
+        I = I.reshape(-1, 1)[pixels]
+    else:
+        Im_t, Xt = image_transform(Im, Th, samples=samples)
+        if samples is not None:
+            I = I.reshape(-1, 1)[samples]
+
+    if metric is not None and samples is None and mask is None:
+        C, dC = metric(Im_t, gradient=True)
+    else:
+        C, dC = correlation_agrad(I, Im_t)
+    g = transform_agrad(dC, Im, Xt, T, dT, SCALING, gradients)
+
+    return C, Im_t, Th, g
+
+
+def affine_mi_agrad(I, Im, x, samples=None, metric=None, mask=None, gradients=None):
+    # Same as affine_mi() but also returns the analytic gradient of
+    # the mutual information w.r.t. the parameters.
+    # metric - optional mutual_information_metric(I, 64), see affine_mi()
+    # mask - optional boolean mask of the fixed image, see rigid_corr()
+    # gradients - optional image_gradient(Im), see transform_agrad()
+    # Output:
+    # MI - mutual information between I and T(Im)
+    # Im_t - transformed moving image T(Im)
+    # Th - homogeneous transformation matrix
+    # g - gradient of MI w.r.t. x
+
+    NUM_BINS = 64
+    SCALING = 100
+
+    T, dT = affine_derivatives(x)
+    Th = util.t2h(T, x[5:]*SCALING)
+
+    if mask is not None:
+        Im_t, Xt, pixels = mask_transform(Im, Th, mask, samples)
+        I = I.reshape(-1, 1)[pixels]
+    else:
+        Im_t, Xt = image_transform(Im, Th, samples=samples)
+        if samples is not None:
+            I = I.reshape(-1, 1)[samples]
+
+    if metric is not None and samples is None and mask is None:
+        MI, dMI = metric(Im_t, gradient=True)
+    else:
+        MI, dMI = mutual_information_agrad(I, Im_t, NUM_BINS)
+    g = transform_agrad(dMI, Im, Xt, T, dT, SCALING, gradients)
+
+    return MI, Im_t, Th, g
+
+
+# SECTION 6. Multi-resolution registration
+
+
+def gaussian_pyramid(I, num_levels, sigma=1.0):
+    # Gaussian image pyramid.
+    # Every level is smoothed with a Gaussian filter and subsampled by
+    # a factor of two w.r.t. the previous level. Subsampling keeps
+    # every second pixel starting from the first one, so pixel (0,0)
+    # stays at the origin and coordinates of level l are 2**l times
+    # smaller than coordinates of the input image.
+    # Input:
+    # I - input image
+    # num_levels - number of levels (including the input image)
+    # sigma - standard deviation of the Gaussian filter
+    # Output:
+    # pyramid - list of images from coarse to fine, the last element
+    #           is the input image
+
+    pyramid = [I]
+
+    for l in range(1, num_levels):
+        I = ndimage.gaussian_filter(I.astype(FLOAT_DTYPE), sigma)[::2, ::2]
+        pyramid.insert(0, I)
+
+    return pyramid
+
+
+def pyramid_registration(I, Im, x, fun, mu, num_iter, num_levels=3, sigma=1.0, optimizer=None, **options):
+    # Coarse-to-fine intensity-based registration.
+    # The last two elements of x are the translation (in pixels divided
+    # by the SCALING constant of the similarity function). They are
+    # divided by 2**l before optimizing at level l and multiplied back
+    # afterwards. The remaining parameters do not depend on the image
+    # resolution.
+    # Input:
+    # I - fixed image
+    # Im - moving image
+    # x - initial parameters at full resolution
+    # fun - similarity function such as rigid_corr(), affine_corr() or
+    #       affine_mi(); functions that also return the gradient such as
+    #       affine_corr_agrad() are used without numerical differentiation
+    # mu - learning rate (or step size, see the optimizer), a single
+    #      value or one value per level (coarse to fine)
+    # num_iter - number of iterations, a single value or one value per
+    #            level (coarse to fine)
+    # num_levels - number of pyramid levels
+    # sigma - standard deviation of the Gaussian filter of the pyramid
+    # optimizer - one of the optimizers of SECTION 7 (default:
+    #             gradient_ascent(), which is defined below)
+    # options - other options of the optimizer, e.g. tol_step or
+    #           executor (see ngradient())
+    # Output:
+    # x - parameters of the transformation at full resolution
+    # similarity - similarity at every iteration (all levels)
+    # Im_t - transformed moving image at full resolution
+
+    if optimizer is None:
+        optimizer = gradient_ascent
+
+    mu = np.broadcast_to(mu, (num_levels,))
+    num_iter = np.broadcast_to(num_iter, (num_levels,))
+
+    I_pyramid = gaussian_pyramid(I, num_levels, sigma)
+    Im_pyramid = gaussian_pyramid(Im, num_levels, sigma)
+
+    x = np.array(x, dtype=float)
+    similarity = []
+
+    for l in range(num_levels):
+        factor = 2**(num_levels-1-l)
+        I_l = I_pyramid[l]
+        Im_l = Im_pyramid[l]
+        # a partial instead of a lambda, so that it can be evaluated in
+        # a process pool
+        level_fun = partial(fun, I_l, Im_l)
+
+        x[-2:] = x[-2:]/factor
+        x, S = optimizer(level_fun, x, mu=mu[l], num_iter=int(num_iter[l]), **options)
+        x[-2:] = x[-2:]*factor
+
+        similarity.append(S)
+
+    _, Im_t, _ = fun(I, Im, x)[:3]
+
+    return x, np.concatenate(similarity), Im_t
+
+
+# SECTION 7. Registration engine
+#
+# All optimizers have the inputs (fun, x, num_iter, ..., callback) and
+# return the final parameters and the similarity at every iteration.
+# fun is the function to be maximized. It can return extra outputs
+# after the value; if it returns four outputs (such as
+# affine_corr_agrad()) the fourth is used as the gradient, otherwise
+# the gradient is computed with ngradient(). The optimization stops
+# early when the change of the similarity is below tol_similarity or
+# the norm of the step is below tol_step (both disabled by default).
+# callback is called as callback(k, x, similarity) after every
+# iteration. executor and num_workers select how the 2*len(x)
+# evaluations of the numerical gradient are run (see ngradient()).
+
+
+def value_and_gradient(fun, x, out=None, executor=None, num_workers=None):
+    # Value and gradient of a function to be maximized.
+    # Input:
+    # fun - function (see above)
+    # x - parameters
+    # out - output of fun(x) if it was already computed
+    # executor, num_workers - evaluation of the numerical gradient, see
+    #                         ngradient()
+    # Output:
+    # S - value of fun at x
+    # g - gradient of fun at x
+
+    if out is None:
+        out = fun(x)
+
+    if isinstance(out, tuple) and len(out) > 3:
+        g = out[3]
+    else:
+        g = ngradient(fun, x, executor=executor, num_workers=num_workers)
+
+    if isinstance(out, tuple):
+        out = out[0]
+
+    return float(np.squeeze(out)), g
+
+
+def converged(similarity, k, step, tol_similarity=None, tol_step=None):
+    # Convergence test of the optimizers.
+    # Input:
+    # similarity - similarity at every iteration
+    # k - current iteration
+    # step - change of the parameters in iteration k
+    # tol_similarity - tolerance on the change of the similarity
+    # tol_step - tolerance on the norm of the step
+    # Output:
+    # True if the optimization should stop
+
+    if tol_similarity is not None and k > 0:
+        if abs(similarity[k] - similarity[k-1]) < tol_similarity:
+            return True
+
+    if tol_step is not None and np.linalg.norm(step) < tol_step:
+        return True
+
+    return False
+
+
+def gradient_ascent(fun, x, mu, num_iter, callback=None, tol_similarity=None, tol_step=None,
+                    executor=None, num_workers=None):
+    # Fixed-step gradient ascent.
+    # Input:
+    # mu - learning rate
+    # (see the beginning of this section for the other inputs)
+    # Output:
+    # x - final parameters
+    # similarity - value of fun at the start of every iteration
+
+    x = np.array(x, dtype=float)
+    similarity = np.full(num_iter, np.nan)
+
+    for k in range(num_iter):
+        similarity[k], g = value_and_gradient(fun, x, executor=executor, num_workers=num_workers)
+
+        step = g*mu
+        x += step
+
+        if callback is not None:
+            callback(k, x, similarity)
+
+        if converged(similarity, k, step, tol_similarity, tol_step):
+            return x, similarity[:k+1]
+
+    return x, similarity
+
+
+def line_search_ascent(fun, x, num_iter, mu=0.001, shrink=0.5, c=1e-4, max_backtracks=20,
+                       callback=None, tol_similarity=None, tol_step=None, executor=None, num_workers=None):
+    # Gradient ascent with a backtracking (Armijo) line search. Every
+    # iteration starts with the step size of the previous iteration
+    # divided by shrink, so the step size adapts in both directions
+    # and does not have to be tuned by hand.
+    # Input:
+    # mu - initial step size
+    # shrink - factor by which the step size is reduced
+    # c - sufficient increase constant of the Armijo condition
+    # max_backtracks - maximum number of reductions per iteration
+    # (see the beginning of this section for the other inputs)
+    # Output:
+    # x - final parameters
+    # similarity - value of fun at the start of every iteration
+
+    x = np.array(x, dtype=float)
+    similarity = np.full(num_iter, np.nan)
+
+    out = None
+    for k in range(num_iter):
+        similarity[k], g = value_and_gradient(fun, x, out, executor, num_workers)
+
+        # reduce the step size until the similarity increases enough
+        for b in range(max_backtracks):
+            step = g*mu
+            out = fun(x + step)
+            S = out[0] if isinstance(out, tuple) else out
+            if np.squeeze(S) >= similarity[k] + c*mu*g.dot(g):
+                break
+            mu = mu*shrink
+        else:
+            # no step size increases the similarity
+            return x, similarity[:k+1]
+
+        x = x + step
+        mu = mu/shrink
+
+        if callback is not None:
+            callback(k, x, similarity)
+
+        if converged(similarity, k, step, tol_similarity, tol_step):
+            return x, similarity[:k+1]
+
+    return x, similarity
+
+
+def momentum_ascent(fun, x, mu, num_iter, beta=0.9, callback=None, tol_similarity=None, tol_step=None,
+                    executor=None, num_workers=None):
+    # Gradient ascent with (heavy ball) momentum.
+    # Input:
+    # mu - learning rate
+    # beta - momentum coefficient
+    # (see the beginning of this section for the other inputs)
+    # Output:
+    # x - final parameters
+    # similarity - value of fun at the start of every iteration
+
+    x = np.array(x, dtype=float)
+    similarity = np.full(num_iter, np.nan)
+    step = np.zeros_like(x)
+
+    for k in range(num_iter):
+        similarity[k], g = value_and_gradient(fun, x, executor=executor, num_workers=num_workers)
+
+        step = beta*step + mu*g
+        x += step
+
+        if callback is not None:
+            callback(k, x, similarity)
+
+        if converged(similarity, k, step, tol_similarity, tol_step):
+            return x, similarity[:k+1]
+
+    return x, similarity
+
+
+def adam(fun, x, mu, num_iter, beta1=0.9, beta2=0.999, epsilon=1e-8, callback=None,
+         tol_similarity=None, tol_step=None, executor=None, num_workers=None):
+    # Adam (adaptive moment estimation) ascent. Every parameter gets
+    # its own step size, so parameters with different ranges (e.g.
+    # rotation and scaled translation) need no separate tuning.
+    # Input:
+    # mu - learning rate (approximately the maximum step per parameter)
+    # beta1, beta2 - decay rates of the first and second moment
+    # epsilon - a small positive number to avoid division by zero
+    # (see the beginning of this section for the other inputs)
+    # Output:
+    # x - final parameters
+    # similarity - value of fun at the start of every iteration
+
+    x = np.array(x, dtype=float)
+    similarity = np.full(num_iter, np.nan)
+    m = np.zeros_like(x)
+    v = np.zeros_like(x)
+
+    for k in range(num_iter):
+        similarity[k], g = value_and_gradient(fun, x, executor=executor, num_workers=num_workers)
+
+        m = beta1*m + (1-beta1)*g
+        v = beta2*v + (1-beta2)*g**2
+        m_hat = m/(1-beta1**(k+1))
+        v_hat = v/(1-beta2**(k+1))
+
+        step = mu*m_hat/(np.sqrt(v_hat) + epsilon)
+        x += step
+
+        if callback is not None:
+            callback(k, x, similarity)
+
+        if converged(similarity, k, step, tol_similarity, tol_step):
+            return x, similarity[:k+1]
+
+    return x, similarity
+
+
+def lbfgsb(fun, x, num_iter, mu=0.01, bounds=None, callback=None, tol_similarity=None, tol_step=None,
+           executor=None, num_workers=None):
+    # Adapter for the L-BFGS-B optimizer of SciPy. The similarity is
+    # maximized by minimizing its negative. Use fixed samples (resample
+    # is False in register()) with this optimizer, since its line search
+    # and curvature estimates assume a deterministic function.
+    # Input:
+    # mu - scale of the parameters: L-BFGS-B optimizes x/mu, so the
+    #      first step has a length of about mu (without the scaling the
+    #      first step has length 1, which moves the image out of view)
+    # bounds - optional list of (min, max) pairs for the parameters
+    # (see the beginning of this section for the other inputs)
+    # Output:
+    # x - final parameters
+    # similarity - value of fun at the end of every iteration
+
+    similarity = []
+    last = {}
+
+    def negative(z):
+        S, g = value_and_gradient(fun, z*mu, executor=executor, num_workers=num_workers)
+        last['z'] = np.copy(z)
+        last['S'] = S
+        # e.g. the correlation is not defined when the moving image is
+        # transformed out of the field of view
+        if not np.isfinite(S):
+            return np.inf, np.zeros_like(z)
+        return -S, -g*mu
+
+    def iteration_done(zk):
+        # the last evaluation is usually at the accepted point
+        if last.get('z') is not None and np.array_equal(last['z'], zk):
+            S = last['S']
+        else:
+            S = first_output(fun, zk*mu)
+        similarity.append(S)
+        k = len(similarity)-1
+        step = (zk - iteration_done.z)*mu
+        iteration_done.z = np.copy(zk)
+        if callback is not None:
+            callback(k, zk*mu, np.array(similarity))
+        if converged(similarity, k, step, tol_similarity, tol_step):
+            raise StopIteration
+
+    z = np.array(x, dtype=float)/mu
+    iteration_done.z = z
+
+    if bounds is not None:
+        bounds = [(None if b[0] is None else b[0]/mu, None if b[1] is None else b[1]/mu) for b in bounds]
+
+    try:
+        result = optimize.minimize(negative, z, jac=True, method='L-BFGS-B',
+                                   bounds=bounds, callback=iteration_done, options={'maxiter': num_iter})
+        z = result.x
+    except StopIteration:
+        # SciPy 1.11 and later stop at the StopIteration of the callback
+        # and return the accepted point; earlier versions pass it on
+        z = iteration_done.z
+
+    return z*mu, np.array(similarity)
+
+
+def evaluate_similarity(similarity, I, Im, samples, extra, num_evals, x):
+    # Evaluation of the similarity function by register(), as a
+    # module-level function so that a partial of it can be evaluated in
+    # a process pool.
+    # Input:
+    # similarity, I, Im - see register()
+    # samples - list with the current samples (or None) as only element
+    # extra - extra inputs of the similarity function (metric, mask,
+    #         gradients)
+    # num_evals - list with the number of evaluations as only element
+    # x - parameters
+    # Output:
+    # outputs of similarity(I, Im, x)
+
+    num_evals[0] += 1
+    with util.stage('similarity'):
+        return similarity(I, Im, x, samples=samples[0], **extra)
+
+
+@util.timed('register')
+def register(I, Im, similarity, x0, optimizer=gradient_ascent, callback=None, callback_every=1,
+             sample_fraction=None, stratified=False, resample=True, metric=None, order=1, mask=None,
+             executor=None, num_workers=None, **options):
+    # Intensity-based registration without any visualization.
+    # Input:
+    # I - fixed image
+    # Im - moving image
+    # similarity - similarity function with inputs (I, Im, x) such as
+    #              rigid_corr(), affine_corr(), affine_mi() or their
+    #              *_agrad variants (which get the spatial gradient of
+    #              the moving image, computed once, see image_gradient())
+    # x0 - initial parameters
+    # optimizer - one of the optimizers above (default: gradient_ascent())
+    # callback - optional function called as callback(k, x, similarity),
+    #            for example to visualize the progress
+    # callback_every - call the callback only every callback_every
+    #                  iterations, and after the last iteration
+    # sample_fraction - if given, the similarity is only evaluated on
+    #                   this fraction of the pixels (see sample_pixels())
+    # stratified - spread the sampled pixels evenly over the image
+    # resample - draw new samples after every iteration (True) or use
+    #            the same samples for the whole registration (False)
+    # metric - optional precomputed metric of the fixed image, such as
+    #          correlation_metric(I) or mutual_information_metric(I, 64),
+    #          passed to the similarity function
+    # order - interpolation order of the moving image; for orders of 2
+    #         and higher the spline coefficients are computed once (see
+    #         SplineImage) and reused by all evaluations
+    # mask - optional boolean mask of the fixed image, passed to the
+    #        similarity function (see rigid_corr()); with sampling only
+    #        the samples inside the mask are used
+    # executor - evaluation of the numerical gradient: None (serially),
+    #            'thread', 'process' or a concurrent.futures executor (see
+    #            ngradient()); a new pool is started once and used for
+    #            the whole registration. With processes the similarity
+    #            function must be picklable, so no metric (a closure)
+    # num_workers - number of workers of a new pool (default: number of
+    #               processors)
+    # options - options of the optimizer, e.g. mu and num_iter for
+    #           gradient_ascent()
+    # Output:
+    # x - parameters of the transformation
+    # S - similarity trace
+    # Im_t - transformed moving image
+    # num_evals - number of evaluations of the similarity function in
+    #             this process (with a process pool the evaluations of
+    #             the numerical gradient are not counted)
+
+    # the samples are kept in a list so that they can be replaced
+    # between iterations; within an iteration (e.g. for all evaluations
+    # of ngradient()) the samples do not change
+    samples = [None]
+    if sample_fraction is not None:
+        samples[0] = sample_pixels(I.shape, sample_fraction, stratified)
+
+    num_evals = [0]
+
+    if order > 1:
+        Im = SplineImage(Im, order)
+
+    extra = {}
+    if metric is not None:
+        extra['metric'] = metric
+    if mask is not None:
+        extra['mask'] = mask
+    # the spatial gradient of the moving image used by the *_agrad
+    # similarity functions does not change during the registration
+    if similarity in (rigid_corr_agrad, affine_corr_agrad, affine_mi_agrad, bspline_corr_agrad, bspline_ssd_agrad):
+        extra['gradients'] = image_gradient(Im)
+
+    if metric is not None and (executor == 'process' or isinstance(executor, ProcessPoolExecutor)):
+        raise AssertionError("A metric cannot be used with a process pool; use executor='thread'.")
+
+    # the samples are read at every evaluation, so the workers of a
+    # thread pool see the new samples; a process pool receives a copy
+    # of the current samples with every evaluation
+    fun = partial(evaluate_similarity, similarity, I, Im, samples, extra, num_evals)
+
+    def iteration_done(k, x, S):
+        if sample_fraction is not None and resample:
+            samples[0] = sample_pixels(I.shape, sample_fraction, stratified)
+        if callback is not None and (k+1) % callback_every == 0:
+            callback(k, x, S)
+
+    with parallel_map(executor, num_workers) as (pool, _):
+        x, S = optimizer(fun, x0, callback=iteration_done, executor=pool, **options)
+
+    # the final state, if the last iteration was skipped by callback_every
+    if callback is not None and len(S) % callback_every != 0:
+        callback(len(S)-1, x, S)
+
+    _, Im_t, _ = similarity(I, Im, x)[:3]
+
+    return x, S, Im_t, num_evals[0]
+
+
+def multi_start_seeds(x0, grid=None, num_random=0, spread=None, seed=None, center=None):
+    # Initial parameters for a multi-start registration.
+    # Input:
+    # x0 - initial parameters
+    # grid - optional coarse grid as a dictionary {parameter index:
+    #        values}, e.g. {0: np.linspace(-np.pi, np.pi, 8,
+    #        endpoint=False)} for a grid of rotation angles; every
+    #        combination of the values is a start, with the other
+    #        parameters of x0
+    # num_random - number of extra starts around x0 (or around every
+    #              grid point)
+    # spread - standard deviation of every parameter of the random
+    #          starts
+    # seed - seed of the random number generator
+    # center - optional point (x, y), such as the image center, about
+    #          which the grid starts of rigid (3) or affine (7)
+    #          parameters rotate: their translation is replaced by the
+    #          one that keeps this point in place, so that a large
+    #          rotation does not move the image out of view
+    # Output:
+    # starts - K-by-len(x0) array of initial parameters
+
+    SCALING = 100
+
+    x0 = np.asarray(x0, dtype=float)
+    starts = [x0]
+
+    if grid is not None:
+        starts = []
+        indices = list(grid)
+        for values in itertools.product(*[grid[k] for k in indices]):
+            x = x0.copy()
+            x[indices] = values
+            if center is not None:
+                T = (rigid_matrix if x.size == 3 else affine_matrix)(x)[:2,:2]
+                x[-2:] = (center - T.dot(center)) / SCALING
+            starts.append(x)
+
+    if num_random > 0:
+        rng = np.random.default_rng(seed)
+        starts = starts + [x + spread*rng.standard_normal(x0.shape) for x in starts for k in range(num_random)]
+
+    return np.array(starts)
+
+
+def register_start(I, Im, similarity, x, options):
+    # One start of multi_start_register(), as a module-level function so
+    # that it can be run in a process pool.
+    # Output:
+    # x - parameters of the transformation
+    # S - similarity trace
+    # num_evals - number of evaluations of the similarity function
+    # S_final - similarity at x
+
+    x, S, _, num_evals = register(I, Im, similarity, x, **options)
+    S_final = float(np.squeeze(similarity(I, Im, x)[0]))
+
+    return x, S, num_evals, S_final
+
+
+def multi_start_register(I, Im, similarity, starts, num_rounds=3, keep=0.5, executor='process',
+                         num_workers=None, **options):
+    # Registration from several initial parameters at once, to escape
+    # the local maxima of the similarity. All starts are optimized for a
+    # short run (one round) in parallel; after every round only the
+    # best fraction 'keep' of the starts continues, so the work goes to
+    # the promising starts.
+    # Input:
+    # I - fixed image
+    # Im - moving image
+    # similarity - similarity function, see register()
+    # starts - K-by-P array of initial parameters, e.g. from
+    #          multi_start_seeds()
+    # num_rounds - number of rounds
+    # keep - fraction of the starts that continues after every round
+    # executor - None, 'thread', 'process' or a concurrent.futures
+    #            executor, see ngradient(); with processes the similarity
+    #            and the options must be picklable (so no metric=
+    #            correlation_metric(I), which is a closure)
+    # num_workers - number of workers of a new pool (default: number of
+    #               processors)
+    # options - options of register() for every round, e.g. optimizer,
+    #           mu and num_iter
+    # Output:
+    # x - parameters of the best start
+    # S - similarity trace of the best start over all rounds
+    # Im_t - moving image transformed with x
+    # num_evals - number of evaluations of the similarity function of
+    #             all starts
+
+    x = [np.asarray(start, dtype=float) for start in np.atleast_2d(starts)]
+    traces = [[] for start in x]
+    num_evals = 0
+
+    def run(map_fun):
+        nonlocal num_evals
+
+        alive = list(range(len(x)))
+
+        for r in range(num_rounds):
+            m = len(alive)
+            results = list(map_fun(register_start, [I]*m, [Im]*m, [similarity]*m,
+                                   [x[k] for k in alive], [options]*m))
+
+            scores = []
+            for k, (x_k, S_k, num_evals_k, S_final) in zip(alive, results):
+                x[k] = x_k
+                traces[k].append(np.ravel(S_k))
+                num_evals += num_evals_k + 1
+                scores.append(S_final if np.isfinite(S_final) else -np.inf)
+
+            # best start first; the losing starts are dropped
+            order = np.argsort(scores)[::-1]
+            num_keep = m if r == num_rounds-1 else max(1, int(np.ceil(keep*m)))
+            alive = [alive[k] for k in order[:num_keep]]
+
+        return alive[0]
+
+    with parallel_map(executor, num_workers) as (_, map_fun):
+        best = run(map_fun)
+
+    _, Im_t, _ = similarity(I, Im, x[best])[:3]
+
+    return x[best], np.concatenate(traces[best]), Im_t, num_evals
+
+
+# SECTION 8. Deformable (B-spline) registration
+#
+# The deformation is a cubic B-spline with control points on a regular
+# grid. Control point (i, j) is located at pixel ((i-1)*spacing,
+# (j-1)*spacing), so the grid covers the image with one extra control
+# point on the top/left and two on the bottom/right. The parameter
+# vector x contains the displacements of all control points: first the
+# column (x) displacements and then the row (y) displacements, each as
+# a raveled grid. Like the translation parameters of the affine
+# transformations, they are in pixels divided by BSPLINE_SCALING. The basis is separable, so
+# the displacement field is By*Phi*Bx' with sparse By and Bx that have
+# four non-zero elements per row.
+
+BSPLINE_SCALING = 100
+
+
+def bspline_grid_size(shape, spacing):
+    # Size of the control point grid of a B-spline deformation.
+    # Input:
+    # shape - size of the image
+    # spacing - distance between the control points in pixels
+    # Output:
+    # grid_size - number of control points in the row and column
+    #             direction
+
+    grid_size = (int((shape[0]-1)//spacing) + 4, int((shape[1]-1)//spacing) + 4)
+
+    return grid_size
+
+
+def bspline_basis(n, spacing, num_control):
+    # Cubic B-spline basis along one image dimension.
+    # Input:
+    # n - number of pixels
+    # spacing - distance between the control points in pixels
+    # num_control - number of control points
+    # Output:
+    # B - sparse n-by-num_control matrix with the weights of the control
+    #     points for every pixel
+
+    u = np.arange(n)/spacing
+    i = np.floor(u).astype(int)
+    t = u - i
+
+    W = np.array([(1-t)**3,
+                  3*t**3 - 6*t**2 + 4,
+                  -3*t**3 + 3*t**2 + 3*t + 1,
+                  t**3]).T / 6
+
+    rows = np.repeat(np.arange(n), 4)
+    cols = (i.reshape(-1, 1) + np.arange(4)).ravel()
+
+    B = sparse.csr_matrix((W.ravel(), (rows, cols)), shape=(n, num_control))
+
+    return B
+
+
+@util.timed('bspline_transform')
+def bspline_transform(Im, x, spacing, grid_size=None):
+    # Image transformation with a B-spline deformation (inverse mapping:
+    # Im_t(X) = Im(X + D(X)), where D is the displacement field).
+    # Input:
+    # Im - image to be transformed
+    # x - displacements of the control points (see above)
+    # spacing - distance between the control points in pixels
+    # grid_size - size of the control point grid (default:
+    #             bspline_grid_size(Im.shape, spacing))
+    # Output:
+    # Im_t - transformed image
+    # D - 2-by-H-by-W displacement field (column and row displacement)
+    # coords - row and column coordinates of the inverse mapping
+    # basis - the basis matrices By and Bx
+
+    if grid_size is None:
+        grid_size = bspline_grid_size(Im.shape, spacing)
+
+    Phi = BSPLINE_SCALING*np.asarray(x, dtype=float).reshape((2,) + tuple(grid_size))
+
+    By = bspline_basis(Im.shape[0], spacing, grid_size[0])
+    Bx = bspline_basis(Im.shape[1], spacing, grid_size[1])
+
+    # By*Phi*Bx' with the sparse matrix always on the left
+    D = np.array([(Bx.dot(By.dot(Phi[k]).T)).T for k in range(2)])
+
+    rows, cols = np.indices(Im.shape, dtype=FLOAT_DTYPE)
+    coords = [rows + D[1], cols + D[0]]
+
+    Im_t = ndimage.map_coordinates(Im, coords, order=1, mode='constant')
+
+    return Im_t, D, coords, (By, Bx)
+
+
+def ssd_agrad(I, J):
+    # Negative mean squared difference between two images (so that it
+    # can be maximized like the other similarity metrics) and its
+    # derivative with respect to the intensities of the second image.
+    # Input:
+    # I, J - input images
+    # Output:
+    # S - negative mean squared difference
+    # dS - derivative of S w.r.t. every pixel of J (same size as J)
+
+    if I.shape != J.shape:
+        raise AssertionError("The inputs must be the same size.")
+
+    E = J.astype(FLOAT_DTYPE) - I.astype(FLOAT_DTYPE)
+
+    S = -np.mean(E**2)
+    dS = -2*E/E.size
+
+    return S, dS
+
+
+@util.timed('bspline_gradient')
+def bspline_agrad(I, Im, x, metric_agrad, spacing, grid_size=None, gradients=None):
+    # Similarity between a fixed image and a moving image transformed
+    # with a B-spline deformation, and its analytic gradient w.r.t. the
+    # control point displacements.
+    # Input:
+    # I - fixed image
+    # Im - moving image
+    # x - displacements of the control points (see above)
+    # metric_agrad - similarity metric with its derivative, such as
+    #                correlation_agrad() or ssd_agrad()
+    # spacing - distance between the control points in pixels
+    # grid_size - size of the control point grid
+    # gradients - optional image_gradient(Im); computed here if not given
+    # Output:
+    # S - similarity between I and T(Im)
+    # Im_t - transformed moving image T(Im)
+    # D - displacement field
+    # g - gradient of S w.r.t. x
+
+    Im_t, D, coords, (By, Bx) = bspline_transform(Im, x, spacing, grid_size)
+
+    S, dS = metric_agrad(I, Im_t)
+
+    # spatial gradient of the moving image at the transformed coordinates
+    Gy, Gx = image_gradient(Im) if gradients is None else gradients
+    Gx = ndimage.map_coordinates(Gx, coords, order=1, mode='constant')
+    Gy = ndimage.map_coordinates(Gy, coords, order=1, mode='constant')
+
+    # the derivative w.r.t. the control points is By'*V*Bx
+    g = np.concatenate([Bx.T.dot(By.T.dot(dS*G).T).T.ravel() for G in [Gx, Gy]])
+    g = g*BSPLINE_SCALING
+
+    return S, Im_t, D, g
+
+
+def bspline_corr_agrad(I, Im, x, samples=None, spacing=16, gradients=None):
+    # Normalized cross-correlation between a fixed image and a moving
+    # image transformed with a B-spline deformation, with its gradient.
+    # Input:
+    # I - fixed image
+    # Im - moving image
+    # x - displacements of the control points (see above)
+    # samples - not supported, must be None (needed for register())
+    # spacing - distance between the control points in pixels
+    # gradients - optional image_gradient(Im), see bspline_agrad()
+    # Output:
+    # C - normalized cross-correlation between I and T(Im)
+    # Im_t - transformed moving image T(Im)
+    # D - displacement field
+    # g - gradient of C w.r.t. x
+
+    if samples is not None:
+        raise AssertionError("B-spline registration does not support sampling.")
+
+    return bspline_agrad(I, Im, x, correlation_agrad, spacing, gradients=gradients)
+
+
+def bspline_ssd_agrad(I, Im, x, samples=None, spacing=16, gradients=None):
+    # Negative mean squared difference between a fixed image and a
+    # moving image transformed with a B-spline deformation, with its
+    # gradient. See bspline_corr_agrad() for the inputs.
+    # Output:
+    # S - negative mean squared difference between I and T(Im)
+    # Im_t - transformed moving image T(Im)
+    # D - displacement field
+    # g - gradient of S w.r.t. x
+
+    if samples is not None:
+        raise AssertionError("B-spline registration does not support sampling.")
+
+    return bspline_agrad(I, Im, x, ssd_agrad, spacing, gradients=gradients)
+
+
+def bspline_registration(I, Im, x=None, spacing=16, metric_agrad=correlation_agrad, num_levels=3,
+                         optimizer=lbfgsb, **options):
+    # Coarse-to-fine B-spline registration. At level l of the Gaussian
+    # pyramid the control point spacing and the displacements are 2**l
+    # times smaller, so the control points stay at the same location
+    # and the parameter vector has the same size at all levels.
+    # Input:
+    # I - fixed image
+    # Im - moving image
+    # x - initial displacements of the control points (default: zero)
+    # spacing - distance between the control points at full resolution
+    # metric_agrad - similarity metric with its derivative, such as
+    #                correlation_agrad() or ssd_agrad()
+    # num_levels - number of pyramid levels
+    # optimizer - one of the optimizers of SECTION 7 (default: lbfgsb())
+    # options - options of the optimizer (e.g. num_iter)
+    # Output:
+    # x - displacements of the control points at full resolution
+    # similarity - similarity at every iteration (all levels)
+    # Im_t - transformed moving image at full resolution
+
+    grid_size = bspline_grid_size(I.shape, spacing)
+
+    if x is None:
+        x = np.zeros(2*grid_size[0]*grid_size[1])
+    x = np.array(x, dtype=float)
+
+    I_pyramid = gaussian_pyramid(I, num_levels)
+    Im_pyramid = gaussian_pyramid(Im, num_levels)
+
+    similarity = []
+
+    for l in range(num_levels):
+        factor = 2**(num_levels-1-l)
+        I_l = I_pyramid[l]
+        Im_l = Im_pyramid[l]
+        # the spatial gradient of the moving image is computed once per
+        # level instead of in every evaluation
+        level_fun = partial(bspline_agrad, I_l, Im_l, metric_agrad=metric_agrad, spacing=spacing/factor,
+                            grid_size=grid_size, gradients=image_gradient(Im_l))
+
+        x, S = optimizer(level_fun, x/factor, **options)
+        x = x*factor
+
+        similarity.append(S)
+
+    Im_t, _, _, _ = bspline_transform(Im, x, spacing, grid_size)
+
+    return x, np.concatenate(similarity), Im_t
+
+
+# SECTION 9. 3D volumes
+#
+# image_transform(), correlation(), joint_histogram() and the
+# utilities in registration_util work with 3D volumes as well, for
+# example the three slices of a subject stacked with
+# np.stack(slices, axis=0). The coordinates are in (x, y, z) order,
+# i.e. columns, rows and slices, and the transformation matrices are
+# 4-by-4 homogeneous matrices. The functions below are the 3D versions
+# of the transformations and similarity functions of SECTION 1 and
+# SECTION 4.
+
+
+def rotate_3d(alpha, beta, gamma):
+    # 3D rotation matrix.
+    # Input:
+    # alpha, beta, gamma - rotation angles around the x, y and z axis
+    # Output:
+    # T - transformation matrix Rz*Ry*Rx
+
+    ca, sa = np.cos(alpha), np.sin(alpha)
+    cb, sb = np.cos(beta), np.sin(beta)
+    cg, sg = np.cos(gamma), np.sin(gamma)
+
+    Rx = np.array([[1,0,0],[0,ca,-sa],[0,sa,ca]])
+    Ry = np.array([[cb,0,sb],[0,1,0],[-sb,0,cb]])
+    Rz = np.array([[cg,-sg,0],[sg,cg,0],[0,0,1]])
+
+    T = Rz.dot(Ry).dot(Rx)
+
+    return T
+
+
+def scale_3d(sx, sy, sz):
+    # 3D scaling matrix.
+    # Input:
+    # sx, sy, sz - scaling parameters
+    # Output:
+    # T - transformation matrix
+
+    T = np.diag([sx, sy, sz]).astype(float)
+
+    return T
+
+
+def shear_3d(cxy, cxz, cyz):
+    # 3D shearing matrix (upper triangular, so that rotation, scaling
+    # and shearing together have the 9 degrees of freedom of a 3D
+    # linear transformation).
+    # Input:
+    # cxy - shear of x along y
+    # cxz - shear of x along z
+    # cyz - shear of y along z
+    # Output:
+    # T - transformation matrix
+
+    T = np.array([[1,cxy,cxz],[0,1,cyz],[0,0,1]], dtype=float)
+
+    return T
+
+
+def affine_3d(x):
+    # 3D affine transformation matrix in homogeneous form.
+    # Input:
+    # x - parameters: three rotation angles, three scaling parameters,
+    #     three shearing parameters and the translation (divided by the
+    #     scaling factor 100)
+    # Output:
+    # Th - homogeneous transformation matrix
+
+    SCALING = 100
+
+    T = rotate_3d(x[0], x[1], x[2]).dot(scale_3d(x[3], x[4], x[5])).dot(shear_3d(x[6], x[7], x[8]))
+    Th = util.t2h(T, x[9:]*SCALING)
+
+    return Th
+
+
+def rigid_corr_3d(I, Im, x, samples=None, chunk_size=None, metric=None):
+    # Computes normalized cross-correlation between a fixed and
+    # a moving volume transformed with a rigid transformation.
+    # Input:
+    # I - fixed volume
+    # Im - moving volume
+    # x - parameters of the rigid transform: the first three elements
+    #     are the rotation angles and the remaining three elements are
+    #     the translation
+    # samples - optional flat indices of the voxels, see rigid_corr()
+    # chunk_size - optional number of voxels transformed at a time, see
+    #     image_transform()
+    # metric - optional correlation_metric(I), see rigid_corr()
+    # Output:
+    # C - normalized cross-correlation between I and T(Im)
+    # Im_t - transformed moving volume T(Im)
+    # Th - homogeneous transformation matrix
+
+    SCALING = 100
+
+    T = rotate_3d(x[0], x[1], x[2])
+    Th = util.t2h(T, x[3:]*SCALING)
+
+    Im_t, Xt = image_transform(Im, Th, samples=samples, chunk_size=chunk_size)
+    if samples is not None:
+        I = I.reshape(-1, 1)[samples]
+
+    if metric is not None and samples is None:
+        C = metric(Im_t)
+    else:
+        C = correlation(I, Im_t)
+
+    return C, Im_t, Th
+
+
+def affine_corr_3d(I, Im, x, samples=None, chunk_size=None, metric=None):
+    # Computes normalized cross-correlation between a fixed and
+    # a moving volume transformed with an affine transformation.
+    # Input:
+    # I - fixed volume
+    # Im - moving volume
+    # x - parameters of the affine transform, see affine_3d()
+    # samples - optional flat indices of the voxels, see rigid_corr()
+    # chunk_size - optional number of voxels transformed at a time, see
+    #     image_transform()
+    # metric - optional correlation_metric(I), see rigid_corr()
+    # Output:
+    # C - normalized cross-correlation between I and T(Im)
+    # Im_t - transformed moving volume T(Im)
+    # Th - homogeneous transformation matrix
+
+    Th = affine_3d(x)
+
+    Im_t, Xt = image_transform(Im, Th, samples=samples, chunk_size=chunk_size)
+    if samples is not None:
+        I = I.reshape(-1, 1)[samples]
+
+    if metric is not None and samples is None:
+        C = metric(Im_t)
+    else:
+        C = correlation(I, Im_t)
+
+    return C, Im_t, Th
+
+
+def affine_mi_3d(I, Im, x, samples=None, chunk_size=None, metric=None):
+    # Computes mutual information between a fixed and
+    # a moving volume transformed with an affine transformation.
+    # Input:
+    # I - fixed volume
+    # Im - moving volume
+    # x - parameters of the affine transform, see affine_3d()
+    # samples - optional flat indices of the voxels, see rigid_corr()
+    # chunk_size - optional number of voxels transformed at a time, see
+    #     image_transform()
+    # metric - optional mutual_information_metric(I, 64), see affine_mi()
+    # Output:
+    # MI - mutual information between I and T(Im)
+    # Im_t - transformed moving volume T(Im)
+    # Th - homogeneous transformation matrix
+
+    NUM_BINS = 64
+
+    Th = affine_3d(x)
+
+    Im_t, Xt = image_transform(Im, Th, samples=samples, chunk_size=chunk_size)
+    if samples is not None:
+        I = I.reshape(-1, 1)[samples]
+
+    if metric is not None and samples is None:
+        MI = metric(Im_t)
+    else:
+        p = joint_histogram(I, Im_t, NUM_BINS)
+        MI = mutual_information(p)
+
+    return MI, Im_t, Th
+
+
+# SECTION 10. Initialization by phase correlation
+#
+# Gradient ascent from the identity transformation is slow and can get
+# stuck when the displacement is large. The functions below estimate a
+# rotation and translation with the FFT, in a few milliseconds, as the
+# starting point of rigid_corr() or affine_corr() registrations. The
+# rotation follows from the magnitude spectra, which do not depend on
+# the translation (Fourier-Mellin), and the translation from the phase
+# correlation of the fixed image and the rotated moving image. This
+# works best for images of the same modality.
+
+
+def phase_correlation(I, J):
+    # Translation between two images by phase correlation.
+    # Input:
+    # I - fixed image
+    # J - moving image of the same size
+    # Output:
+    # t - translation (x, y) in pixels such that J translated by t is
+    #     most similar to I, i.e. I(p) ~ J(p - t)
+    # peak - height of the phase correlation peak (1 for a pure
+    #        translation, close to 0 for unrelated images)
+
+    if I.shape != J.shape:
+        raise AssertionError("The inputs must be the same size.")
+
+    # the images are real, so only half of the spectra are needed
+    F = np.fft.rfft2(I.astype(float)) * np.conj(np.fft.rfft2(J.astype(float)))
+    F = F / (np.abs(F) + 1e-12)
+    C = np.fft.irfft2(F, s=I.shape)
+
+    k = np.unravel_index(np.argmax(C), C.shape)
+    peak = C[k]
+
+    # sub-pixel position of the peak from a parabola through the peak
+    # and its (circular) neighbours, and shifts larger than half the
+    # image size are negative shifts
+    t = np.zeros(2)
+    for axis in range(2):
+        before = list(k)
+        after = list(k)
+        before[axis] = (k[axis] - 1) % C.shape[axis]
+        after[axis] = (k[axis] + 1) % C.shape[axis]
+        c0, c1, c2 = C[tuple(before)], peak, C[tuple(after)]
+        denominator = c0 - 2*c1 + c2
+        offset = 0.5*(c0 - c2)/denominator if denominator < 0 else 0
+
+        shift = k[axis] + offset
+        if shift > C.shape[axis]/2:
+            shift = shift - C.shape[axis]
+        # (x, y) order
+        t[1-axis] = shift
+
+    return t, peak
+
+
+def rotation_correlation(I, J, num_angles=360):
+    # Rotation between two images from the correlation of their
+    # magnitude spectra in polar coordinates. Since the magnitude
+    # spectrum of a real image is symmetric, the rotation is only found
+    # up to 180 degrees.
+    # Input:
+    # I - fixed image
+    # J - moving image of the same size
+    # num_angles - number of angles in [-pi/2, pi/2) of the polar sampling
+    # Output:
+    # phi - rotation angle in radians (in [-pi/2, pi/2)) such that J
+    #       rotated by phi is most similar to I
+
+    if I.shape != J.shape:
+        raise AssertionError("The inputs must be the same size.")
+
+    # window against the edges of the images, which would dominate the
+    # spectra with horizontal and vertical lines
+    window = np.outer(np.hanning(I.shape[0]), np.hanning(I.shape[1]))
+
+    # the windowed images are zero-padded to a square, so that a
+    # frequency index is the same frequency along both axes and the
+    # polar grid below is not distorted for non-square images
+    size = max(I.shape)
+
+    # polar sampling of the log-magnitude spectra, skipping the lowest
+    # frequencies; the half spectra of rfft2() contain the non-negative
+    # x frequencies, i.e. the angles in [-pi/2, pi/2), with the y
+    # frequencies centered by fftshift()
+    center = size // 2
+    theta = np.arange(num_angles) * np.pi / num_angles - np.pi/2
+    radius = np.arange(2, size//2)
+    rows = center + np.outer(np.sin(theta), radius)
+    cols = np.outer(np.cos(theta), radius)
+
+    polar = []
+    for K in (I, J):
+        M = np.log1p(np.abs(np.fft.fftshift(np.fft.rfft2(K.astype(float)*window, s=(size, size)), axes=0)))
+        P = ndimage.map_coordinates(M, [rows, cols], order=1)
+        polar.append(P - P.mean(axis=0))
+
+    # circular cross-correlation along the angles, summed over the radii
+    F = np.fft.fft(polar[0], axis=0) * np.conj(np.fft.fft(polar[1], axis=0))
+    C = np.real(np.fft.ifft(F.sum(axis=1)))
+
+    k = np.argmax(C)
+    c0, c1, c2 = C[k-1], C[k], C[(k+1) % num_angles]
+    denominator = c0 - 2*c1 + c2
+    offset = 0.5*(c0 - c2)/denominator if denominator < 0 else 0
+
+    # the angles of both spectra start at -pi/2, so the shift is the
+    # rotation
+    phi = (k + offset) * np.pi / num_angles
+    if phi >= np.pi/2:
+        phi = phi - np.pi
+
+    return phi
+
+
+def phase_correlation_init(I, Im, affine=False, num_angles=360):
+    # Initial parameters of a rigid_corr() or affine_corr() registration
+    # from the rotation and translation found by phase correlation.
+    # Input:
+    # I - fixed image
+    # Im - moving image
+    # affine - return parameters for affine_corr() instead of rigid_corr()
+    # num_angles - number of angles of rotation_correlation()
+    # Output:
+    # x - initial parameters
+
+    SCALING = 100
+
+    phi = rotation_correlation(I, Im, num_angles)
+
+    # rotations about the image center, so that the rotated moving image
+    # stays in view; both phi and phi+pi are tried and the one with the
+    # highest phase correlation peak is kept (a rotation by pi about the
+    # center flips both axes)
+    c = (np.array(I.shape[::-1]) - 1) / 2
+    Im_r, _ = image_transform(Im, util.t2h(rotate(phi), c - rotate(phi).dot(c)))
+
+    candidates = []
+    for angle, Im_r in ((phi, Im_r), (phi + np.pi, Im_r[::-1, ::-1])):
+        R = rotate(angle)
+        t, peak = phase_correlation(I, Im_r)
+        x = np.concatenate(([angle], (c - R.dot(c) + t) / SCALING))
+        candidates.append((peak, x))
+
+    _, x = max(candidates, key=lambda candidate: candidate[0])
+
+    # angle in [-pi, pi)
+    x[0] = (x[0] + np.pi) % (2*np.pi) - np.pi
+
+    if affine:
+        x = np.concatenate((x[:1], [1., 1., 0., 0.], x[1:]))
+
+    return x
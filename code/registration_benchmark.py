@@ -0,0 +1,321 @@
+"""
+Registration benchmarks.
+"""
+
+import os
+import json
+import time
+import tracemalloc
+import numpy as np
+import matplotlib.pyplot as plt
+import registration as reg
+import registration_util as util
+from registration_project import REGISTRATION_METHODS, find_image_pairs
+
+
+# known transformations used to generate the synthetic moving images,
+# in the parameters of the similarity functions
+SYNTHETIC_TRANSFORMS = {
+    'rigid_corr': np.array([0.05, 0.03, -0.02]),
+    'rigid_mi': np.array([0.05, 0.03, -0.02]),
+    'affine_corr': np.array([0.05, 1.05, 0.95, 0.02, 0., 0.03, -0.02]),
+    'affine_mi': np.array([0.05, 1.05, 0.95, 0.02, 0., 0.03, -0.02]),
+}
+
+
+def measure(fun, *args, repeat=5, **kwargs):
+    # Wall time and peak memory of a function call.
+    # Input:
+    # fun - function to measure
+    # args, kwargs - inputs of the function
+    # repeat - number of timed calls; the fastest one is reported
+    # Output:
+    # result - dictionary with the time of one call in seconds, the
+    #          number of calls per second and the peak memory of one
+    #          call in bytes
+    # output - output of the function
+
+    times = []
+    for k in range(repeat):
+        start = time.perf_counter()
+        output = fun(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+
+    # the memory is measured in a separate call since tracing slows
+    # down the function
+    tracemalloc.start()
+    fun(*args, **kwargs)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {'time': min(times), 'calls_per_second': 1/min(times), 'peak_memory': peak_memory}
+
+    return result, output
+
+
+def benchmark_components(fixed='../data/image_data/1_1_t1.tif', moving='../data/image_data/1_1_t2.tif',
+                         repeat=20):
+    # Benchmark of the building blocks of an intensity-based
+    # registration on one pair of images.
+    # Input:
+    # fixed - path of the fixed image
+    # moving - path of the moving image
+    # repeat - number of timed calls of every function
+    # Output:
+    # results - dictionary with the result of measure() per function
+
+    I = plt.imread(fixed)
+    Im = plt.imread(moving)
+    Th = util.t2h(reg.rotate(0.1).dot(reg.shear(0.05, 0)), np.array([3, -2]))
+    Im_t, _ = reg.image_transform(Im, Th)
+
+    # the same number of bins as the MI similarity functions
+    num_bins = 64
+    p = reg.joint_histogram(I, Im_t, num_bins)
+    cc_metric = reg.correlation_metric(I)
+    mi_metric = reg.mutual_information_metric(I, num_bins)
+
+    components = {
+        'image_transform': (reg.image_transform, (Im, Th)),
+        'correlation': (reg.correlation, (I, Im_t)),
+        'correlation_metric': (cc_metric, (Im_t,)),
+        'joint_histogram': (reg.joint_histogram, (I, Im_t, num_bins)),
+        'mutual_information': (reg.mutual_information, (p,)),
+        'mutual_information_metric': (mi_metric, (Im_t,)),
+    }
+
+    results = {}
+    for name, (fun, args) in components.items():
+        results[name], _ = measure(fun, *args, repeat=repeat)
+
+    return results
+
+
+def registration_error(Th, Th_true, shape):
+    # Mean displacement in pixels between two transformations over all
+    # pixels of an image.
+    # Input:
+    # Th - estimated homogeneous transformation matrix
+    # Th_true - true homogeneous transformation matrix
+    # shape - size of the image
+    # Output:
+    # E - mean distance between the transformed pixel positions
+
+    X = util.sampling_grid(*shape)
+    D = (Th - Th_true).dot(X)[:-1]
+
+    return np.mean(np.sqrt(np.sum(D**2, axis=0)))
+
+
+def benchmark_registration(method, fixed, moving=None, optimizer=reg.gradient_ascent, num_iter=None, repeat=3):
+    # Benchmark of a full intensity-based registration.
+    # Input:
+    # method - name of a method in REGISTRATION_METHODS
+    # fixed - path of the fixed image
+    # moving - path of the moving image; if None, the moving image is
+    #          the fixed image transformed with SYNTHETIC_TRANSFORMS[method]
+    #          and the registration error is reported
+    # optimizer - optimizer used by reg.register()
+    # num_iter - number of iterations (default from REGISTRATION_METHODS)
+    # repeat - number of timed registrations; the fastest one is
+    #          reported, since a single run is too noisy to compare
+    #          with a baseline
+    # Output:
+    # result - dictionary with the time, number of evaluations,
+    #          evaluations per second, peak memory, final similarity and
+    #          (synthetic images only) registration error in pixels
+
+    x, mu, default_num_iter = REGISTRATION_METHODS[method]
+    similarity = getattr(reg, method)
+
+    if num_iter is None:
+        num_iter = default_num_iter
+
+    I = plt.imread(fixed)
+
+    if moving is None:
+        _, _, Th_true = similarity(I, I, SYNTHETIC_TRANSFORMS[method])
+        Im, _ = reg.image_transform(I, util.inv_h(Th_true))
+    else:
+        Im = plt.imread(moving)
+
+    if method.endswith('corr'):
+        metric = reg.correlation_metric(I)
+    else:
+        metric = reg.mutual_information_metric(I, 64)
+
+    result, output = measure(reg.register, I, Im, similarity, x, optimizer=optimizer,
+                             mu=mu, num_iter=num_iter, metric=metric, repeat=repeat)
+    x, S, _, num_evals = output
+
+    result['num_evals'] = num_evals
+    result['evals_per_second'] = num_evals/result['time']
+    result['similarity'] = float(np.squeeze(similarity(I, Im, x)[0]))
+
+    if moving is None:
+        result['error'] = float(registration_error(similarity(I, Im, x)[2], Th_true, I.shape))
+
+    return result
+
+
+def run_benchmarks(data_dir='../data/image_data', methods=None, num_pairs=1, num_iter=None):
+    # Run all benchmarks: the building blocks and, per method, the
+    # registration of a synthetic pair with a known transformation and
+    # of the first 'num_pairs' T1/deformed T1 pairs in 'data_dir'.
+    # Input:
+    # data_dir - directory with the images
+    # methods - names of methods in REGISTRATION_METHODS (default: all)
+    # num_pairs - number of image pairs per method
+    # num_iter - number of iterations (default from REGISTRATION_METHODS)
+    # Output:
+    # results - dictionary with a result per benchmark name
+
+    if methods is None:
+        methods = list(REGISTRATION_METHODS)
+
+    pairs = find_image_pairs(data_dir, 't1_d')[:num_pairs]
+
+    results = benchmark_components(pairs[0][0], pairs[0][1].replace('t1_d', 't2'))
+
+    for method in methods:
+        results[method + '/synthetic'] = benchmark_registration(method, pairs[0][0], num_iter=num_iter)
+        for fixed, moving in pairs:
+            name = method + '/' + os.path.basename(moving)
+            results[name] = benchmark_registration(method, fixed, moving, num_iter=num_iter)
+
+    return results
+
+
+def compare_precision(fixed='../data/image_data/1_1_t1.tif', moving='../data/image_data/1_1_t1_d.tif',
+                      method='affine_corr', num_iter=100):
+    # Compare single precision (reg.set_float_dtype(np.float32)) with
+    # double precision on one pair of images.
+    # Input:
+    # fixed - path of the fixed image
+    # moving - path of the moving image
+    # method - name of a method in REGISTRATION_METHODS
+    # num_iter - number of iterations of the registration
+    # Output:
+    # results - dictionary with per precision the benchmark_components()
+    #           and benchmark_registration() results, and the differences
+    #           between the two precisions
+
+    I = plt.imread(fixed)
+    Im = plt.imread(moving)
+    Th = util.t2h(reg.rotate(0.1).dot(reg.shear(0.05, 0)), np.array([3.3, -2.1]))
+    x, mu, _ = REGISTRATION_METHODS[method]
+
+    results = {}
+    outputs = {}
+
+    default_dtype = reg.FLOAT_DTYPE
+    try:
+        for dtype in (np.float64, np.float32):
+            reg.set_float_dtype(dtype)
+            name = np.dtype(dtype).name
+
+            results[name] = benchmark_components(fixed, moving)
+            results[name][method] = benchmark_registration(method, fixed, moving, num_iter=num_iter)
+
+            It, _ = reg.image_transform(Im, Th)
+            x_reg, _, _, _ = reg.register(I, Im, getattr(reg, method), x, mu=mu, num_iter=num_iter)
+            outputs[name] = (It, reg.correlation(I, It), reg.mutual_information(reg.joint_histogram(I, It, 64)),
+                             reg.mutual_information_metric(I, 64)(It), x_reg)
+    finally:
+        reg.set_float_dtype(default_dtype)
+
+    It64, CC64, MI64, MIm64, x64 = outputs['float64']
+    It32, CC32, MI32, MIm32, x32 = outputs['float32']
+    diff = np.abs(It64.astype(float) - It32.astype(float))
+
+    results['difference'] = {
+        'image_transform_max': float(diff.max()),
+        'image_transform_fraction': float(np.mean(diff > 0)),
+        'correlation': float(abs(CC64 - CC32)),
+        'mutual_information': float(abs(MI64 - MI32)),
+        'mutual_information_metric': float(abs(MIm64 - MIm32)),
+        'similarity': abs(results['float64'][method]['similarity'] - results['float32'][method]['similarity']),
+        'parameters': float(np.max(np.abs(x64 - x32))),
+    }
+
+    return results
+
+
+def save_baseline(results, baseline_file='registration_benchmark.json'):
+    # Save benchmark results as the baseline for later comparisons.
+    # Input:
+    # results - output of run_benchmarks()
+    # baseline_file - path of the JSON file
+
+    with open(baseline_file, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def compare_baseline(results, baseline_file='registration_benchmark.json', time_tolerance=0.25,
+                     memory_tolerance=0.1, similarity_tolerance=0.005, error_tolerance=0.5):
+    # Compare benchmark results to a saved baseline.
+    # Input:
+    # results - output of run_benchmarks()
+    # baseline_file - path of the JSON file written by save_baseline()
+    # time_tolerance - allowed relative increase of the time
+    # memory_tolerance - allowed relative increase of the peak memory
+    # similarity_tolerance - allowed decrease of the final similarity
+    # error_tolerance - allowed increase of the registration error in pixels
+    # Output:
+    # regressions - list of descriptions of the regressions (empty if
+    #               there are none)
+
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+
+    regressions = []
+
+    def check(name, key, value, limit):
+        # value is compared with limit, but the message reports the
+        # result itself (value is negated for the similarity)
+        if value > limit:
+            regressions.append('{}: {} {:.4g} (baseline {:.4g})'.format(name, key, results[name][key],
+                                                                       baseline[name][key]))
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        check(name, 'time', result['time'], old['time']*(1 + time_tolerance))
+        check(name, 'peak_memory', result['peak_memory'], old['peak_memory']*(1 + memory_tolerance))
+        if 'similarity' in old:
+            # a lower similarity is a regression
+            check(name, 'similarity', -result['similarity'], -old['similarity'] + similarity_tolerance)
+        if 'error' in old:
+            check(name, 'error', result['error'], old['error'] + error_tolerance)
+
+    return regressions
+
+
+def print_results(results):
+    # Print benchmark results as a table.
+    # Input:
+    # results - output of run_benchmarks()
+
+    print('{:32} {:>10} {:>10} {:>12} {:>10} {:>10}'.format(
+        'benchmark', 'time [ms]', 'evals/s', 'memory [MB]', 'similarity', 'error'))
+
+    for name, result in results.items():
+        evals = result.get('evals_per_second', result['calls_per_second'])
+        print('{:32} {:10.2f} {:10.1f} {:12.2f} {:>10} {:>10}'.format(
+            name, 1000*result['time'], evals, result['peak_memory']/2**20,
+            '{:.4f}'.format(result['similarity']) if 'similarity' in result else '',
+            '{:.3f}'.format(result['error']) if 'error' in result else ''))
+
+
+if __name__ == '__main__':
+    results = run_benchmarks()
+    print_results(results)
+
+    baseline_file = 'registration_benchmark.json'
+    if os.path.exists(baseline_file):
+        regressions = compare_baseline(results, baseline_file)
+        for regression in regressions:
+            print('Regression: ' + regression)
+    else:
+        save_baseline(results, baseline_file)
@@ -2,43 +2,44 @@
 Registration project code.
 """
 
+import os
+import csv
+import glob
+import time
 import numpy as np
 import matplotlib.pyplot as plt
 import registration as reg
+from concurrent.futures import ProcessPoolExecutor
 from IPython.display import display, clear_output
 
 
-def intensity_based_registration_demo():
-
-    # read the fixed and moving images
-    # change these in order to read different images
-    I = plt.imread('../data/image_data/1_1_t1.tif')
-    Im = plt.imread('../data/image_data/1_1_t1_d.tif')
-
-    # initial values for the parameters
-    # we start with the identity transformation
-    # most likely you will not have to change these
-    x = np.array([0., 0., 0.])
-
-    # NOTE: for affine registration you have to initialize
-    # more parameters and the scaling parameters should be
-    # initialized to 1 instead of 0
-
-    # the similarity function
-    # this line of code in essence creates a version of rigid_corr()
-    # in which the first two input parameters (fixed and moving image)
-    # are fixed and the only remaining parameter is the vector x with the
-    # parameters of the transformation
-    fun = lambda x: reg.rigid_corr(I, Im, x)
-
-    # the learning rate
-    mu = 0.003
-
-    # number of iterations
-    num_iter = 200
+# initial parameters, learning rate and number of iterations of the
+# intensity-based registration methods (as in the functions below;
+# rigid_mi uses the learning rate of affine_mi)
+REGISTRATION_METHODS = {
+    'rigid_corr': (np.array([0., 0., 0.]), 0.003, 200),
+    'rigid_mi': (np.array([0., 0., 0.]), 0.00006, 50),
+    'affine_corr': (np.array([0., 1., 1., 0., 0., 0., 0.]), 0.0006, 250),
+    'affine_mi': (np.array([0., 1., 1., 0., 0., 0., 0.]), 0.00006, 50),
+}
+
+
+def registration_display(I, Im, similarity, x, num_iter):
+    # Figure for following an intensity-based registration. Returns a
+    # callback for reg.register() that redraws the figure; the
+    # transformed moving image is only computed when the figure is
+    # redrawn.
+    # Input:
+    # I - fixed image
+    # Im - moving image
+    # similarity - similarity function used for the registration
+    # x - initial parameters
+    # num_iter - number of iterations
+    # Output:
+    # update - callback with inputs (k, x, similarity)
 
     iterations = np.arange(1, num_iter+1)
-    similarity = np.full((num_iter, 1), np.nan)
+    similarity_trace = np.full((num_iter, 1), np.nan)
 
     fig = plt.figure(figsize=(14,6))
 
@@ -58,20 +59,14 @@ def intensity_based_registration_demo():
     # 'learning' curve
     ax2 = fig.add_subplot(122, xlim=(0, num_iter), ylim=(0, 1))
 
-    learning_curve, = ax2.plot(iterations, similarity, lw=2)
+    learning_curve, = ax2.plot(iterations, similarity_trace, lw=2)
     ax2.set_xlabel('Iteration')
     ax2.set_ylabel('Similarity')
     ax2.grid()
 
-    # perform 'num_iter' gradient ascent updates
-    for k in np.arange(num_iter):
-
-        # gradient ascent
-        g = reg.ngradient(fun, x)
-        x += g*mu
-
+    def update(k, x, S):
         # for visualization of the result
-        S, Im_t, _ = fun(x)
+        _, Im_t, _ = similarity(I, Im, x)[:3]
 
         clear_output(wait = True)
 
@@ -79,12 +74,51 @@ def intensity_based_registration_demo():
         im2.set_data(Im_t)
         txt.set_text(np.array2string(x, precision=5, floatmode='fixed'))
 
-        # update 'learning' curve
-        similarity[k] = S
-        learning_curve.set_ydata(similarity)
+        # update 'learning' curve (after the last iteration S only has
+        # the iterations that were run)
+        learning_curve.set_data(iterations[:len(S)], S)
 
         display(fig)
 
+    return update
+
+
+def intensity_based_registration_demo(display_every=10, executor=None):
+
+    # read the fixed and moving images
+    # change these in order to read different images
+    I = plt.imread('../data/image_data/1_1_t1.tif')
+    Im = plt.imread('../data/image_data/1_1_t1_d.tif')
+
+    # initial values for the parameters
+    # we start with the identity transformation
+    # most likely you will not have to change these
+    x = np.array([0., 0., 0.])
+
+    # NOTE: for affine registration you have to initialize
+    # more parameters and the scaling parameters should be
+    # initialized to 1 instead of 0
+
+    # the similarity function
+    similarity = reg.rigid_corr
+
+    # the learning rate
+    mu = 0.003
+
+    # number of iterations
+    num_iter = 200
+
+    # the figure is only redrawn every 'display_every' iterations
+    update = registration_display(I, Im, similarity, x, num_iter)
+
+    # perform 'num_iter' gradient ascent updates
+    # executor='thread' or 'process' evaluates the numerical gradient in
+    # parallel (see reg.register())
+    x, S, Im_t, _ = reg.register(I, Im, similarity, x, mu=mu, num_iter=num_iter,
+        callback=update, callback_every=display_every, executor=executor)
+
+    return x, S, Im_t
+
 # ------------------------------------------------------------------#
 # TODO: Eigen code om poin-based registration uit te voeren
 import registration_util as util
@@ -122,7 +156,7 @@ def my_point_based_registration_2():
     Im1 = ax1.imshow(I_plt_2)     # Fixed image or Transformed image, Je mag wisselen
     Im2 = ax1.imshow(transformed_moving_image_2, alpha=0.7)   # Transformed image or Fixed image  Mag wisselen
     
-def intensity_based_registration_affine_cc(im1, im2):
+def intensity_based_registration_affine_cc(im1, im2, display_every=10, executor=None):
 
     # read the fixed and moving images
     # change these in order to read different images
@@ -134,16 +168,8 @@ def intensity_based_registration_affine_cc(im1, im2):
     # most likely you will not have to change these
     x = np.array([0., 1., 1., 0., 0., 0., 0.])
 
-    # NOTE: for affine registration you have to initialize
-    # more parameters and the scaling parameters should be
-    # initialized to 1 instead of 0
-
     # the similarity function
-    # this line of code in essence creates a version of rigid_corr()
-    # in which the first two input parameters (fixed and moving image)
-    # are fixed and the only remaining parameter is the vector x with the
-    # parameters of the transformation
-    fun = lambda x: reg.affine_corr(I, Im, x)
+    similarity = reg.affine_corr
 
     # the learning rate
     #mu = 0.0004 
@@ -152,55 +178,18 @@ def intensity_based_registration_affine_cc(im1, im2):
     # number of iterations
     num_iter = 250
 
-    iterations = np.arange(1, num_iter+1)
-    similarity = np.full((num_iter, 1), np.nan)
-
-    fig = plt.figure(figsize=(14,6))
-
-    # fixed and moving image, and parameters
-    ax1 = fig.add_subplot(121)
-
-    # fixed image
-    im1 = ax1.imshow(I)
-    # moving image
-    im2 = ax1.imshow(I, alpha=0.7)
-    # parameters
-    txt = ax1.text(0.3, 0.95,
-        np.array2string(x, precision=5, floatmode='fixed'),
-        bbox={'facecolor': 'white', 'alpha': 1, 'pad': 10},
-        transform=ax1.transAxes)
-
-    # 'learning' curve
-    ax2 = fig.add_subplot(122, xlim=(0, num_iter), ylim=(0, 1))
-
-    learning_curve, = ax2.plot(iterations, similarity, lw=2)
-    ax2.set_xlabel('Iteration')
-    ax2.set_ylabel('Similarity')
-    ax2.grid()
+    # the figure is only redrawn every 'display_every' iterations
+    update = registration_display(I, Im, similarity, x, num_iter)
 
     # perform 'num_iter' gradient ascent updates
-    for k in np.arange(num_iter):
+    # executor='thread' or 'process' evaluates the numerical gradient in
+    # parallel (see reg.register())
+    x, S, Im_t, _ = reg.register(I, Im, similarity, x, mu=mu, num_iter=num_iter,
+        callback=update, callback_every=display_every, executor=executor)
 
-        # gradient ascent
-        g = reg.ngradient(fun, x)
-        x += g*mu
+    return x, S, Im_t
 
-        # for visualization of the result
-        S, Im_t, _ = fun(x)
-
-        clear_output(wait = True)
-
-        # update moving image and parameters
-        im2.set_data(Im_t)
-        txt.set_text(np.array2string(x, precision=5, floatmode='fixed'))
-
-        # update 'learning' curve
-        similarity[k] = S
-        learning_curve.set_ydata(similarity)
-
-        display(fig)
-
-def intensity_based_registration_affine_mi(im1, im2):
+def intensity_based_registration_affine_mi(im1, im2, display_every=10, executor=None):
 
     # read the fixed and moving images
     # change these in order to read different images
@@ -212,16 +201,8 @@ def intensity_based_registration_affine_mi(im1, im2):
     # most likely you will not have to change these
     x = np.array([0., 1., 1., 0., 0., 0., 0.])
 
-    # NOTE: for affine registration you have to initialize
-    # more parameters and the scaling parameters should be
-    # initialized to 1 instead of 0
-
     # the similarity function
-    # this line of code in essence creates a version of rigid_corr()
-    # in which the first two input parameters (fixed and moving image)
-    # are fixed and the only remaining parameter is the vector x with the
-    # parameters of the transformation
-    fun = lambda x: reg.affine_mi(I, Im, x)
+    similarity = reg.affine_mi
 
     # the learning rate
     mu = 0.00006
@@ -229,50 +210,109 @@ def intensity_based_registration_affine_mi(im1, im2):
     # number of iterations
     num_iter = 50
 
-    iterations = np.arange(1, num_iter+1)
-    similarity = np.full((num_iter, 1), np.nan)
-
-    fig = plt.figure(figsize=(14,6))
-
-    # fixed and moving image, and parameters
-    ax1 = fig.add_subplot(121)
-
-    # fixed image
-    im1 = ax1.imshow(I)
-    # moving image
-    im2 = ax1.imshow(I, alpha=0.7)
-    # parameters
-    txt = ax1.text(0.3, 0.95,
-        np.array2string(x, precision=5, floatmode='fixed'),
-        bbox={'facecolor': 'white', 'alpha': 1, 'pad': 10},
-        transform=ax1.transAxes)
-
-    # 'learning' curve
-    ax2 = fig.add_subplot(122, xlim=(0, num_iter), ylim=(0, 1))
-
-    learning_curve, = ax2.plot(iterations, similarity, lw=2)
-    ax2.set_xlabel('Iteration')
-    ax2.set_ylabel('Similarity')
-    ax2.grid()
+    # the figure is only redrawn every 'display_every' iterations
+    update = registration_display(I, Im, similarity, x, num_iter)
 
     # perform 'num_iter' gradient ascent updates
-    for k in np.arange(num_iter):
-
-        # gradient ascent
-        g = reg.ngradient(fun, x)
-        x += g*mu
-
-        # for visualization of the result
-        S, Im_t, _ = fun(x)
-
-        clear_output(wait = True)
-
-        # update moving image and parameters
-        im2.set_data(Im_t)
-        txt.set_text(np.array2string(x, precision=5, floatmode='fixed'))
-
-        # update 'learning' curve
-        similarity[k] = S
-        learning_curve.set_ydata(similarity)
-
-        display(fig)
\ No newline at end of file
+    # executor='thread' or 'process' evaluates the numerical gradient in
+    # parallel (see reg.register())
+    x, S, Im_t, _ = reg.register(I, Im, similarity, x, mu=mu, num_iter=num_iter,
+        callback=update, callback_every=display_every, executor=executor)
+
+    return x, S, Im_t
+
+
+def find_image_pairs(data_dir='../data/image_data', moving='t1_d'):
+    # Find all pairs of fixed and moving images in a directory with
+    # images named <patient>_<slice>_<modality>.tif.
+    # Input:
+    # data_dir - directory with the images
+    # moving - modality of the moving image: 't1_d' (deformed T1 image)
+    #          or 't2' (T2 image); the fixed image is always the T1 image
+    # Output:
+    # pairs - list of (fixed image path, moving image path)
+
+    pairs = []
+
+    for fixed_path in sorted(glob.glob(os.path.join(data_dir, '*_t1.tif'))):
+        moving_path = fixed_path[:-len('t1.tif')] + moving + '.tif'
+        if os.path.exists(moving_path):
+            pairs.append((fixed_path, moving_path))
+
+    return pairs
+
+
+def register_pair(pair, method='affine_corr', initialize=False):
+    # Intensity-based registration of one pair of images without
+    # visualization (used by batch_registration()).
+    # Input:
+    # pair - (fixed image path, moving image path)
+    # method - name of a method in REGISTRATION_METHODS
+    # initialize - start from the rotation and translation found by
+    #              phase correlation (reg.phase_correlation_init())
+    #              instead of the identity transformation
+    # Output:
+    # result - dictionary with the image paths, method, parameters,
+    #          final similarity, registration time in seconds and
+    #          number of evaluations of the similarity function
+
+    x, mu, num_iter = REGISTRATION_METHODS[method]
+
+    I = plt.imread(pair[0])
+    Im = plt.imread(pair[1])
+
+    start = time.perf_counter()
+    if initialize:
+        x = reg.phase_correlation_init(I, Im, affine=method.startswith('affine'))
+    # precomputed statistics of the fixed image (the MI similarity
+    # functions use 64 bins)
+    if method.endswith('corr'):
+        metric = reg.correlation_metric(I)
+    else:
+        metric = reg.mutual_information_metric(I, 64)
+    x, S, _, num_evals = reg.register(I, Im, getattr(reg, method), x, mu=mu, num_iter=num_iter,
+                                      metric=metric)
+    elapsed = time.perf_counter() - start
+
+    similarity, _, _ = getattr(reg, method)(I, Im, x)
+
+    result = {'fixed': pair[0], 'moving': pair[1], 'method': method,
+              'similarity': float(np.squeeze(similarity)), 'time': elapsed,
+              'num_evals': num_evals, 'x': x}
+
+    return result
+
+
+def batch_registration(method='affine_corr', moving='t1_d', data_dir='../data/image_data',
+                       results_file='registration_results.csv', num_workers=None, initialize=False):
+    # Register all image pairs in a directory in parallel and write the
+    # results to a CSV file (one row per pair).
+    # Input:
+    # method - name of a method in REGISTRATION_METHODS
+    # moving - modality of the moving image ('t1_d' or 't2')
+    # data_dir - directory with the images
+    # results_file - path of the CSV file
+    # num_workers - number of processes (default: number of processors)
+    # initialize - start every registration from phase correlation,
+    #              see register_pair()
+    # Output:
+    # results - list of results of register_pair()
+
+    pairs = find_image_pairs(data_dir, moving)
+    methods = [method]*len(pairs)
+
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        results = list(pool.map(register_pair, pairs, methods, [initialize]*len(pairs)))
+
+    num_params = len(REGISTRATION_METHODS[method][0])
+
+    with open(results_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['fixed', 'moving', 'method', 'similarity', 'time', 'num_evals'] +
+                        ['x' + str(k) for k in range(num_params)])
+        for result in results:
+            writer.writerow([result['fixed'], result['moving'], result['method'],
+                             result['similarity'], result['time'], result['num_evals']] +
+                            list(result['x']))
+
+    return results
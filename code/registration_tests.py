@@ -2,10 +2,14 @@
 Test code for registration.
 """
 
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import matplotlib.pyplot as plt
 import registration as reg
 import registration_util as util
+from scipy import ndimage
 from IPython.display import display, clear_output
 
 
@@ -115,6 +119,59 @@ def arbitrary_rotation():
 
 # SECTION 2. Image transformation and least squares fitting
 
+def transform_objects_test():
+
+    x = np.array([0.3, 1.1, 0.9, 0.2, -0.1, 0.05, -0.02])
+    T = util.t2h(reg.rotate(x[0]).dot(reg.scale(x[1], x[2]).dot(reg.shear(x[3], x[4]))), x[5:]*100)
+    assert np.allclose(reg.affine_matrix(x), T), "Closed form affine matrix is incorrect"
+    assert np.allclose(reg.rigid_matrix(x[[0, 5, 6]]), util.t2h(reg.rotate(x[0]), x[5:]*100)), "Closed form rigid matrix is incorrect"
+
+    A = reg.Transform.affine(x)
+    B = reg.Transform.rigid([0.1, 0.2, 0.3])
+    C = reg.Transform(util.t2h(reg.scale(2, 3), np.array([1, 2])))
+
+    # lazy composition of a chain, with arrays on either side
+    ABC = A @ B @ C
+    assert np.allclose(ABC.matrix, A.matrix.dot(B.matrix).dot(C.matrix)), "Composition is incorrect"
+    assert np.allclose((C.matrix @ (A @ B)).matrix, C.matrix.dot(A.matrix).dot(B.matrix)), "Composition with an array is incorrect"
+    assert np.allclose(np.asarray(ABC), ABC.matrix), "Conversion to an array is incorrect"
+
+    # the inverse is cached and its inverse is the transform itself
+    assert ABC.inverse is ABC.inverse and ABC.inverse.inverse is ABC, "Inverse is not cached"
+    assert np.allclose(ABC.inverse.matrix.dot(ABC.matrix), np.eye(3)), "Inverse is incorrect"
+
+    # image_transform() accepts transforms
+    I = plt.imread('../data/image_data/1_1_t1.tif')
+    assert np.array_equal(reg.image_transform(I, A)[0], reg.image_transform(I, A.matrix)[0]), "Transformation of an image with a Transform is incorrect"
+
+    print('Test successful!')
+
+
+def inv_h_test():
+
+    # closed form inverse of 2D affine matrices, the general inverse of
+    # 3D affine and projective matrices, and matrices given as lists
+    Th_2d = util.t2h(reg.rotate(0.3).dot(reg.scale(1.2, 0.8)).dot(reg.shear(0.1, -0.2)), np.array([5, -3]))
+    Th_3d = reg.affine_3d(np.array([0.02, -0.01, 0.05, 1.1, 0.9, 1, 0.1, 0, 0, 0.02, -0.03, 0]))
+    Th_projective = Th_2d.copy()
+    Th_projective[2,:2] = [0.001, -0.002]
+    for Th in [Th_2d, Th_3d, Th_projective, Th_2d.tolist()]:
+        assert np.allclose(util.inv_h(Th), np.linalg.inv(Th)), "Inverse of a homogeneous matrix is incorrect"
+
+    I = plt.imread('../data/image_data/1_1_t1.tif')
+    assert np.array_equal(reg.image_transform(I, Th_2d.tolist())[0], reg.image_transform(I, Th_2d)[0]), "Transformation with a matrix given as a list is incorrect"
+
+    # the sampling grid is cached per size and type and read-only
+    X = util.sampling_grid(2, 3)
+    assert np.array_equal(X, [[0, 1, 2, 0, 1, 2], [0, 0, 0, 1, 1, 1], [1, 1, 1, 1, 1, 1]]), "Sampling grid is incorrect"
+    assert util.sampling_grid(2, 3) is X and util.sampling_grid(2, 3, dtype=np.float32) is not X, "Sampling grid is not cached per size and type"
+    assert not X.flags.writeable, "Sampling grid must be read-only"
+    X = util.sampling_grid(2, 3, 4)
+    assert X.shape == (4, 24) and np.array_equal(X[:3,-1], [3, 2, 1]), "3D sampling grid is incorrect"
+
+    print('Test successful!')
+
+
 def image_transform_test():
 
     I = plt.imread('../data/cameraman.tif')
@@ -154,6 +211,204 @@ def image_transform_test():
     ax3.set_title('Scaling')
 
 
+def image_transform_3d_test():
+
+    # volume of the three slices of a subject
+    V = np.stack([plt.imread('../data/dataset_brains/1_' + str(k) + '_t1.tif') for k in [1, 2, 3]])
+
+    # a 3D transformation that does not change the z coordinate must
+    # transform every slice as the corresponding 2D transformation
+    T_2d = util.t2h(reg.rotate(0.1), np.array([3, 4]))
+    T_3d = util.t2h(np.eye(3), np.zeros(3))
+    T_3d[:2,:2] = T_2d[:2,:2]
+    T_3d[:2,3] = T_2d[:2,2]
+
+    Vt, _ = reg.image_transform(V, T_3d)
+    Vt_slices = np.stack([reg.image_transform(S, T_2d)[0] for S in V])
+    assert np.array_equal(Vt, Vt_slices), "3D image transformation differs from the 2D one"
+
+    # chunked transformation gives the same result
+    Th = reg.affine_3d(np.array([0.02, -0.01, 0.05, 1.1, 0.9, 1, 0.1, 0, 0, 0.02, -0.03, 0]))
+    Vt, _ = reg.image_transform(V, Th)
+    Vt_chunked, _ = reg.image_transform(V, Th, chunk_size=10000)
+    assert np.array_equal(Vt, Vt_chunked), "Chunked image transformation differs from the unchunked one"
+    assert np.allclose(util.inv_h(Th), np.linalg.inv(Th)), "Inverse of a 3D transformation is incorrect"
+
+    # sampled voxels are spread over the whole volume and the sampled
+    # similarity is close to the full one
+    x = np.array([0, 0, 0.02, 1, -2, 0])
+    C = reg.rigid_corr_3d(V, V, x)[0]
+    for stratified in (False, True):
+        samples = reg.sample_pixels(V.shape, 0.2, stratified=stratified)
+        assert abs(samples.size - 0.2*V.size) < 0.05*V.size, "Number of sampled voxels is incorrect"
+        z = np.unravel_index(samples, V.shape)[0]
+        assert np.array_equal(np.unique(z), np.arange(V.shape[0])), "Sampled voxels do not cover the volume"
+        C_sampled = reg.rigid_corr_3d(V, V, x, samples=samples)[0]
+        assert np.isfinite(C_sampled) and abs(C_sampled - C) < 0.02, "Sampled 3D similarity is incorrect"
+
+    print('Test successful!')
+
+
+def image_transform_batch_test():
+
+    I = plt.imread('../data/image_data/1_1_t1.tif')
+    Th = np.stack([reg.affine_matrix(np.array([0.1*k, 1 + 0.02*k, 1 - 0.01*k, 0.01*k, 0, 0.03, -0.02*k]))
+                   for k in range(7)])
+
+    # every chunk size, also ones that do not divide the number of
+    # matrices, and a cropped output give the per-matrix result
+    for output_shape in (None, (150, 200)):
+        It = np.stack([reg.image_transform(I, T, output_shape=output_shape)[0] for T in Th])
+        for chunk_size in (1, 3, 16, 100):
+            It_batch = reg.image_transform_batch(I, Th, output_shape=output_shape, chunk_size=chunk_size)
+            assert It_batch.shape == It.shape, "Batch image transformation has the wrong size"
+            assert np.allclose(It_batch, It, atol=1e-3), "Batch image transformation differs from the per-matrix one"
+
+    print('Test successful!')
+
+
+def image_transform_tiled_test():
+
+    I = plt.imread('../data/image_data/1_1_t1.tif')
+    Th = util.t2h(reg.rotate(0.2).dot(reg.shear(0.1, 0)), np.array([5, -3]))
+
+    # tiles that do not divide the image size and a cropped output
+    It, _ = reg.image_transform(I, Th, output_shape=(150, 200))
+    It_tiled = reg.image_transform_tiled(I, Th, output_shape=(150, 200), tile_shape=(64, 50))
+    assert np.array_equal(It, It_tiled), "Tiled image transformation differs from the untiled one"
+
+    # writing into a memory-mapped output
+    path = os.path.join(tempfile.mkdtemp(), 'It.npy')
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=I.dtype, shape=I.shape)
+    reg.image_transform_tiled(I, Th, tile_shape=100, out=out)
+    out.flush()
+    It, _ = reg.image_transform(I, Th)
+    assert np.array_equal(It, np.load(path)), "Memory-mapped output differs from the untiled one"
+
+    # 3D volume
+    V = np.stack([I, I, I])
+    Th = reg.affine_3d(np.array([0.02, -0.01, 0.05, 1.1, 0.9, 1, 0.1, 0, 0, 0.02, -0.03, 0]))
+    Vt, _ = reg.image_transform(V, Th)
+    assert np.array_equal(Vt, reg.image_transform_tiled(V, Th, tile_shape=(2, 100, 100))), "Tiled 3D image transformation is incorrect"
+
+    print('Test successful!')
+
+
+def spline_image_test():
+
+    I = plt.imread('../data/image_data/1_1_t1.tif')
+    Th = reg.affine_matrix(np.array([0.1, 1.05, 0.95, 0.05, 0, 0.03, -0.02]))
+
+    # cached spline coefficients give the same result as a prefilter
+    # per transformation
+    for order in (2, 3, 5):
+        S = reg.SplineImage(I, order)
+        It, _ = reg.image_transform(I, Th, order=order)
+        assert np.array_equal(reg.image_transform(S, Th)[0], It), "Transformation of a SplineImage is incorrect"
+        assert np.array_equal(reg.image_transform_tiled(S, Th, tile_shape=100), It), "Tiled transformation of a SplineImage is incorrect"
+
+    # the cubic spline is exact for a translation by whole pixels
+    Th = util.t2h(reg.identity(), np.array([3, -2]))
+    It, _ = reg.image_transform(reg.SplineImage(I.astype(float)), Th)
+    assert np.allclose(It[5:-5,5:-5], I[7:-3,2:-8]), "Cubic interpolation is incorrect"
+
+    print('Test successful!')
+
+
+def timing_test():
+
+    I = plt.imread('../data/image_data/1_1_t1.tif')
+    Th = util.t2h(reg.rotate(0.2), np.array([5, -3]))
+
+    util.enable_timing()
+    It, _ = reg.image_transform(I, Th)
+    It, _ = reg.image_transform(I, Th)
+    C = reg.correlation(I, It)
+    report = util.disable_timing()
+
+    assert report['interpolation']['calls'] == 2, "Interpolation stage is not recorded"
+    assert report['correlation']['calls'] == 1, "Correlation stage is not recorded"
+    assert report['interpolation']['time'] > 0, "Stage time is not recorded"
+
+    # nothing is recorded when the timing is disabled
+    It, _ = reg.image_transform(I, Th)
+    assert util.timing_report() == {}, "Stages are recorded while the timing is disabled"
+
+    # disabling the timing while a stage runs
+    util.enable_timing()
+    with util.stage('outer'):
+        report = util.disable_timing()
+    assert util.timing_report() == {} and 'outer' not in report, "Stage that ends after disabling the timing is recorded"
+
+    # stages of concurrent threads are all counted
+    util.enable_timing()
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda k: reg.image_transform(I, Th), range(40)))
+    report = util.disable_timing()
+    assert report['interpolation']['calls'] == 40, "Stages of concurrent threads are not all recorded"
+
+    print('Test successful!')
+
+
+def float32_test():
+
+    I = plt.imread('../data/image_data/1_1_t1.tif')
+    Im = plt.imread('../data/image_data/1_1_t2.tif')
+    x = np.array([0.1, 1.05, 0.95, 0.05, 0, 0.03, -0.02])
+
+    results = {}
+    try:
+        for dtype in (np.float64, np.float32):
+            reg.set_float_dtype(dtype)
+            It, Xt = reg.image_transform(Im, util.t2h(reg.rotate(0.1), np.array([3, -2])))
+            assert Xt.dtype == dtype, "Coordinates do not have the selected type"
+            results[dtype] = (It, reg.correlation(I, It),
+                reg.mutual_information(reg.joint_histogram(I, It, 64)),
+                reg.affine_corr_agrad(I, Im, x)[3])
+    finally:
+        reg.set_float_dtype(np.float64)
+
+    It64, CC64, MI64, g64 = results[np.float64]
+    It32, CC32, MI32, g32 = results[np.float32]
+
+    assert np.abs(It64.astype(int) - It32).max() <= 1, "Single precision image transformation is inaccurate"
+    assert np.isclose(CC64, CC32, rtol=0, atol=1e-5), "Single precision correlation is inaccurate"
+    assert np.isclose(MI64, MI32, rtol=0, atol=1e-4), "Single precision mutual information is inaccurate"
+    assert np.allclose(g64, g32, rtol=1e-3, atol=1e-5), "Single precision gradient is inaccurate"
+
+    print('Test successful!')
+
+
+def resampling_operator_test():
+
+    T1 = plt.imread('../data/dataset_brains/1_1_t1.tif')
+    T2 = plt.imread('../data/dataset_brains/1_1_t2.tif')
+    gt = plt.imread('../data/dataset_brains/1_1_gt.tif')
+    Th = reg.affine_matrix(np.array([0.1, 1.05, 0.95, 0.05, 0, 0.03, -0.02]))
+
+    # one operator for all channels gives the same result as
+    # image_transform() for every channel
+    W = reg.resampling_operator(Th, T1.shape)
+    It = reg.resample(W, np.stack([T1, T2]), T1.shape)
+    assert np.array_equal(It[0], reg.image_transform(T1, Th)[0]), "Resampling of the T1 image is incorrect"
+    assert np.array_equal(It[1], reg.image_transform(T2, Th)[0]), "Resampling of the T2 image is incorrect"
+    assert reg.resample(W, T1[np.newaxis], T1.shape).shape == (1,) + T1.shape, "Resampling of a stack of one channel returns the wrong size"
+
+    # nearest-neighbour interpolation keeps the labels
+    W = reg.resampling_operator(Th, gt.shape, nearest=True)
+    gt_t = reg.resample(W, gt, gt.shape)
+    _, Xt = reg.image_transform(gt, Th)
+    gt_nn = ndimage.map_coordinates(gt, Xt[1::-1], order=0, mode='constant').reshape(gt.shape)
+    assert np.array_equal(gt_t, gt_nn), "Nearest-neighbour resampling is incorrect"
+    assert set(np.unique(gt_t)) <= set(np.unique(gt)), "Nearest-neighbour resampling creates new labels"
+
+    # output size that differs from the input size
+    W = reg.resampling_operator(Th, T1.shape, (100, 150))
+    assert np.array_equal(reg.resample(W, T1, (100, 150)), reg.image_transform(T1, Th, (100, 150))[0]), "Resampling to another size is incorrect"
+
+    print('Test successful!')
+
+
 def ls_solve_test():
     #------------------------------------------------------------------#
     # TODO: Test your implementation of the ls_solve definition
@@ -201,6 +456,34 @@ def ls_affine_test():
     ax3.grid()
 
 
+
+def ls_affine_batch_test():
+
+    X = util.c2h(util.test_object(1))
+    rng = np.random.default_rng(0)
+
+    # many sets of the same points transformed with random transformations
+    N = 1000
+    T = np.stack([util.t2h(reg.rotate(a).dot(reg.scale(1+a, 1-a)), 10*rng.normal(size=2))
+        for a in rng.uniform(-0.3, 0.3, N)])
+    Xm = T @ X
+
+    Te, E = reg.ls_affine_batch(np.repeat(X[None], N, axis=0), Xm)
+    assert np.allclose(Te, np.linalg.inv(T)), "Batched affine fitting is incorrect"
+    assert np.allclose(Te[0], reg.ls_affine(X, Xm[0])), "Batched affine fitting differs from ls_affine"
+    assert np.allclose(E, 0), "Error of an exact fit is not zero"
+
+    # a quarter of wrong correspondences
+    Xm = Xm[0].copy()
+    wrong = rng.choice(X.shape[1], X.shape[1]//4, replace=False)
+    Xm[:2,wrong] += 50*rng.normal(size=(2, len(wrong)))
+
+    Te, inliers = reg.ls_affine_ransac(X, Xm, seed=0)
+    assert np.allclose(Te, np.linalg.inv(T[0])), "RANSAC affine fitting is incorrect"
+    assert not np.any(inliers[wrong]), "Wrong correspondences are inliers"
+
+    print('Test successful!')
+
 # SECTION 3. Image similarity metrics
 
 def correlation_test():
@@ -223,6 +506,36 @@ def correlation_test():
     print('Test successful!')
 
 
+def joint_histogram_test():
+
+    I = plt.imread('../data/cameraman.tif')
+    J = np.random.rand(*I.shape)*255
+
+    for num_bins in [16, 64, 256]:
+        for minmax_range in [None, [0, 255]]:
+            p = reg.joint_histogram(I, J, num_bins, minmax_range)
+
+            # reference: accumulate the counts one pixel at a time
+            rng = minmax_range
+            if rng is None:
+                rng = [min(I.min(), J.min()), max(I.max(), J.max())]
+            a = np.round((I.ravel()-rng[0])/(rng[1]-rng[0])*(num_bins-1)).astype(int)
+            b = np.round((J.ravel()-rng[0])/(rng[1]-rng[0])*(num_bins-1)).astype(int)
+            p_ref = np.zeros((num_bins, num_bins))
+            for k in range(a.size):
+                p_ref[a[k], b[k]] += 1
+            p_ref = p_ref/a.size
+
+            assert p.shape == (num_bins, num_bins), "Joint histogram has the wrong size"
+            assert np.array_equal(p, p_ref), "Joint histogram is incorrectly implemented (reference test)"
+
+    # values outside a given range are counted in the first or last bin
+    p = reg.joint_histogram(np.array([250., 100.]), np.array([259., -3.]), 64, [0, 255])
+    assert p[62, 63] == 0.5 and p[25, 0] == 0.5, "Values outside the range are counted in the wrong bins"
+
+    print('Test successful!')
+
+
 def mutual_information_test():
 
     I = plt.imread('../data/cameraman.tif')
@@ -246,6 +559,44 @@ def mutual_information_test():
     print('Test successful!')
 
 
+def mutual_information_metric_test():
+
+    I = plt.imread('../data/image_data/1_1_t1.tif')
+    J = plt.imread('../data/image_data/1_1_t2.tif')
+
+    for num_bins in [16, 64]:
+        for minmax_range in [None, [0, 255]]:
+            mi = reg.mutual_information_metric(I, num_bins, minmax_range)
+            # the second image extends the range of the first one only
+            # if the range is not fixed
+            images = [J, J*0.5 + 3.3]
+            if minmax_range is None:
+                images.append(J*1.3)
+            for K in images:
+                MI1 = mi(K)
+                MI2 = reg.mutual_information(reg.joint_histogram(I, K, num_bins, minmax_range))
+                assert abs(MI1 - MI2) < 1e-9, "Mutual information metric differs from the reference implementation"
+
+    # values outside a given range
+    mi = reg.mutual_information_metric(I, 64, [0, 255])
+    K = J.astype(float)*1.5 - 40
+    MI2 = reg.mutual_information(reg.joint_histogram(I, K, 64, [0, 255]))
+    assert abs(mi(K) - MI2) < 1e-9, "Mutual information metric is incorrect for values outside the range"
+    MI, dMI = mi(K, gradient=True)
+    assert abs(MI - MI2) < 1e-9 and np.all(np.isfinite(dMI)), "Mutual information gradient is incorrect for values outside the range"
+
+    # concurrent calls with images that alternately extend the range
+    mi = reg.mutual_information_metric(I, 64)
+    images = [J*s for s in (1, 1.3, 1.1, 1.5)]*8
+    with ThreadPoolExecutor(4) as executor:
+        MI = list(executor.map(mi, images))
+    for K, MI1 in zip(images, MI):
+        MI2 = reg.mutual_information(reg.joint_histogram(I, K, 64))
+        assert abs(MI1 - MI2) < 1e-9, "Mutual information metric is incorrect with concurrent calls"
+
+    print('Test successful!')
+
+
 def mutual_information_e_test():
 
     I = plt.imread('../data/cameraman.tif')
@@ -279,11 +630,296 @@ def ngradient_test():
     print(exponential)
     print(g1)
 
+    # concurrent evaluation of the perturbations gives the same gradient
+    quadratic = lambda x: np.sum(x**2)
+    x = np.array([1., -2., 3.])
+    g2 = reg.ngradient(quadratic, x)
+    g3 = reg.ngradient(quadratic, x, executor='thread', num_workers=2)
+    assert np.allclose(g2, 2*x), "Numerical gradient is incorrectly implemented (quadratic test)"
+    assert np.array_equal(g2, g3), "Numerical gradient with a thread pool differs from the serial one"
+
     #------------------------------------------------------------------#
 
     print('Test successful!')
 
 
+def agrad_test():
+
+    I = plt.imread('../data/image_data/1_1_t1.tif')
+    Im = plt.imread('../data/image_data/1_1_t1_d.tif')
+
+    x = np.array([0.05, 1.05, 0.97, 0.02, -0.03, 0.03, -0.02])
+
+    C, _, _, g = reg.affine_corr_agrad(I, Im, x)
+    g_num = reg.ngradient(lambda x: reg.affine_corr(I, Im, x)[0].item(), x)
+
+    assert abs(C - reg.affine_corr(I, Im, x)[0].item()) < 1e-10, "Analytic gradient function returns a different similarity"
+    assert np.linalg.norm(g - g_num) < 0.1*np.linalg.norm(g_num), "Analytic gradient is incorrectly implemented (comparison with ngradient)"
+
+    # the mutual information is piecewise constant, so only the
+    # direction of the gradient can be compared
+    _, _, _, g = reg.affine_mi_agrad(I, Im, x)
+    g_num = reg.ngradient(lambda x: reg.affine_mi(I, Im, x)[0], x, h=1e-2)
+
+    assert g.dot(g_num) > 0, "Analytic gradient of the mutual information points in the wrong direction"
+
+    # a precomputed spatial gradient of the moving image gives the same
+    # gradient
+    samples = reg.sample_pixels(I.shape, 0.1)
+    _, _, _, g1 = reg.affine_corr_agrad(I, Im, x, samples=samples)
+    _, _, _, g2 = reg.affine_corr_agrad(I, Im, x, samples=samples, gradients=reg.image_gradient(Im))
+    assert np.array_equal(g1, g2), "Gradient with a precomputed image gradient is incorrect"
+
+    print('Test successful!')
+
+
+def gaussian_pyramid_test():
+
+    I = plt.imread('../data/image_data/1_1_t1.tif').astype(float)
+
+    # moving image with a known rigid transformation
+    x = np.array([0.1, 0.08, -0.05])
+    Th = util.t2h(reg.rotate(x[0]), x[1:]*100)
+    Im, _ = reg.image_transform(I, np.linalg.inv(Th))
+
+    I_pyramid = reg.gaussian_pyramid(I, 3)
+    Im_pyramid = reg.gaussian_pyramid(Im, 3)
+
+    assert I_pyramid[-1] is I, "The last level of the pyramid must be the input image"
+    assert I_pyramid[0].shape == (I.shape[0]//4, I.shape[1]//4), "Pyramid levels have the wrong size"
+
+    # the known transformation with the translation rescaled to the
+    # coarsest level should register the coarsest images
+    x_c = np.concatenate((x[:1], x[1:]/4))
+    C, _, _ = reg.rigid_corr(I_pyramid[0], Im_pyramid[0], x_c)
+    assert C > 0.99, "Translation parameters are incorrectly rescaled between pyramid levels"
+
+    # the coarse-to-fine registration recovers the known transformation
+    # with optimizers of SECTION 7, and the default gradient ascent
+    # improves the similarity
+    for optimizer, mu, num_iter in [(reg.adam, [0.01, 0.003, 0.001], [100, 40, 20]),
+                                    (reg.lbfgsb, 0.01, 30)]:
+        x_reg, S, Im_t = reg.pyramid_registration(I, Im, np.zeros(3), reg.rigid_corr_agrad, mu, num_iter,
+                                                  optimizer=optimizer)
+        assert np.abs(x_reg - x).max() < 0.005, "Pyramid registration with " + optimizer.__name__ + " did not find the transformation"
+        assert Im_t.shape == I.shape, "Pyramid registration returns the wrong image size"
+
+    x_reg, S, _ = reg.pyramid_registration(I, Im, np.zeros(3), reg.rigid_corr_agrad, 0.0003, [100, 40, 20])
+    assert len(S) == 160 and S[-1] > S[0] + 0.1, "Pyramid registration with gradient ascent does not improve the similarity"
+
+    print('Test successful!')
+
+
+def sampled_similarity_test():
+
+    I = plt.imread('../data/image_data/1_1_t1.tif')
+    Im = plt.imread('../data/image_data/1_1_t1_d.tif')
+
+    x = np.array([0.05, 1.05, 0.97, 0.02, -0.03, 0.03, -0.02])
+
+    # sampling all pixels gives the same similarity
+    samples = reg.sample_pixels(I.shape, 1)
+    C1, _, _ = reg.affine_corr(I, Im, x)
+    C2, Im_t, _ = reg.affine_corr(I, Im, x, samples=samples)
+    assert abs(C1 - C2) < 1e-10, "Similarity of all sampled pixels differs from the full similarity"
+
+    # a subset of the pixels gives a close approximation
+    for stratified in [False, True]:
+        samples = reg.sample_pixels(I.shape, 0.1, stratified)
+        assert len(np.unique(samples)) == len(samples), "Pixels are sampled more than once"
+        C3, Im_t, _ = reg.affine_corr(I, Im, x, samples=samples)
+        assert Im_t.shape == (len(samples), 1), "Only the sampled pixels should be transformed"
+        assert abs(C1 - C3) < 0.05, "Similarity of the sampled pixels is not close to the full similarity"
+
+    print('Test successful!')
+
+
+def masked_similarity_test():
+
+    I = plt.imread('../data/image_data/1_1_t1.tif')
+    Im = plt.imread('../data/image_data/1_1_t1_d.tif')
+
+    x = np.array([0.05, 1.05, 0.97, 0.02, -0.03, 0.03, -0.02])
+    mask = ndimage.binary_fill_holes(I > 10)
+
+    # a mask of all pixels and a transformation that keeps the whole
+    # image in view gives the same similarity
+    x0 = np.array([0., 1., 1., 0., 0., 0., 0.])
+    C1, _, _ = reg.affine_corr(I, Im, x0)
+    C2, _, _ = reg.affine_corr(I, Im, x0, mask=np.ones(I.shape, dtype=bool))
+    assert abs(C1 - C2) < 1e-10, "Similarity with a full mask differs from the full similarity"
+
+    # only the pixels in the mask and in the field of view are compared
+    for similarity in [reg.rigid_corr, reg.affine_corr, reg.affine_mi]:
+        p = x[[0, 5, 6]] if similarity is reg.rigid_corr else x
+        S, Im_t, Th = similarity(I, Im, p, mask=mask)
+        _, Xt, pixels = reg.mask_transform(Im, Th, mask)
+        assert np.all(mask.reshape(-1)[pixels]), "Pixels outside the mask are compared"
+        assert np.all((Xt[:2] >= 0) & (Xt[:2] <= 287)), "Pixels outside the field of view are compared"
+        assert Im_t.shape == (len(pixels), 1), "Only the pixels in the mask should be transformed"
+
+    C, Im_t, Th = reg.affine_corr(I, Im, x, mask=mask)
+    _, _, pixels = reg.mask_transform(Im, Th, mask)
+    assert abs(C - reg.correlation(I.reshape(-1, 1)[pixels], Im_t)) < 1e-10, "Masked similarity is incorrect"
+
+    # sampling within the mask
+    samples = reg.sample_pixels(I.shape, 0.1)
+    _, Im_t, _ = reg.affine_corr(I, Im, x, samples=samples, mask=mask)
+    assert len(Im_t) <= np.sum(mask.reshape(-1)[samples]), "Samples outside the mask are compared"
+
+    # the analytic gradient of the masked similarity matches the
+    # numerical one (only in direction for the mutual information, see
+    # agrad_test()), also in a registration
+    C, _, _, g = reg.affine_corr_agrad(I, Im, x, mask=mask)
+    g_num = reg.ngradient(lambda x: reg.affine_corr(I, Im, x, mask=mask)[0], x)
+    assert abs(C - reg.affine_corr(I, Im, x, mask=mask)[0]) < 1e-10, "Masked similarity with gradient is incorrect"
+    assert np.linalg.norm(g - g_num) < 0.1*np.linalg.norm(g_num), "Masked analytic gradient is incorrect"
+    _, _, _, g = reg.affine_mi_agrad(I, Im, x, mask=mask)
+    g_num = reg.ngradient(lambda x: reg.affine_mi(I, Im, x, mask=mask)[0], x, h=1e-2)
+    assert g.dot(g_num) > 0, "Masked analytic gradient of the mutual information points in the wrong direction"
+    x_reg, S, _, _ = reg.register(I, Im, reg.rigid_corr_agrad, np.zeros(3), mask=mask, mu=0.003, num_iter=10)
+    assert S[-1] > S[0], "Masked registration with the analytic gradient does not increase the similarity"
+
+    print('Test successful!')
+
+
+def optimizers_test():
+
+    # concave function with a maximum at a
+    a = np.array([0.5, -1., 2.])
+    fun = lambda x: -np.sum((x-a)**2)
+    x0 = np.zeros(3)
+
+    optimizers = [(reg.gradient_ascent, {'mu': 0.1, 'num_iter': 200}),
+                  (reg.line_search_ascent, {'mu': 0.1, 'num_iter': 200}),
+                  (reg.momentum_ascent, {'mu': 0.05, 'num_iter': 200}),
+                  (reg.adam, {'mu': 0.05, 'num_iter': 500}),
+                  (reg.lbfgsb, {'num_iter': 100})]
+
+    for optimizer, options in optimizers:
+        x, S = optimizer(fun, x0, tol_step=1e-6, **options)
+        assert np.allclose(x, a, atol=1e-2), optimizer.__name__ + " does not find the maximum"
+        assert len(S) <= options['num_iter'], optimizer.__name__ + " returns too many similarity values"
+
+    # the convergence test stops the optimization early
+    x, S = reg.gradient_ascent(fun, x0, 0.1, 1000, tol_similarity=1e-8)
+    assert len(S) < 1000, "Optimization does not stop at convergence"
+
+    # the callback of register() is called every callback_every
+    # iterations and after the last iteration
+    I = plt.imread('../data/image_data/1_1_t1.tif')
+    Im = plt.imread('../data/image_data/1_1_t1_d.tif')
+    for callback_every, expected in [(10, [9, 19, 24]), (5, [4, 9, 14, 19, 24]), (1, list(range(25)))]:
+        calls = []
+        reg.register(I, Im, reg.rigid_corr_agrad, np.zeros(3), mu=0.003, num_iter=25,
+                     callback=lambda k, x, S: calls.append(k), callback_every=callback_every)
+        assert calls == expected, "Callback is called at the wrong iterations"
+
+    # a registration with the numerical gradient evaluated in a thread
+    # or process pool gives the same result as a serial one
+    x, S, _, _ = reg.register(I, Im, reg.rigid_corr, np.zeros(3), mu=0.003, num_iter=5)
+    for executor in ('thread', 'process'):
+        x_parallel, S_parallel, _, _ = reg.register(I, Im, reg.rigid_corr, np.zeros(3), mu=0.003, num_iter=5,
+                                                    executor=executor, num_workers=2)
+        assert np.array_equal(x, x_parallel) and np.array_equal(S, S_parallel), \
+            "Registration with executor=" + executor + " differs from the serial one"
+
+    print('Test successful!')
+
+
+def multi_start_test():
+
+    I = plt.imread('../data/image_data/1_1_t1.tif')
+
+    # a rotation far outside the reach of a single start at the identity
+    c = (np.array(I.shape[::-1]) - 1) / 2
+    R = reg.rotate(2.0)
+    Th = util.t2h(R, c - R.dot(c) + np.array([3, -2]))
+    Im, _ = reg.image_transform(I, util.inv_h(Th))
+
+    starts = reg.multi_start_seeds(np.zeros(3), grid={0: np.linspace(-np.pi, np.pi, 6, endpoint=False)}, center=c)
+    assert starts.shape == (6, 3), "Grid of starts is incorrect"
+
+    x, S, Im_t, num_evals = reg.multi_start_register(I, Im, reg.rigid_corr_agrad, starts, num_rounds=2,
+        executor='thread', optimizer=reg.lbfgsb, num_iter=20)
+    assert abs(x[0] - 2.0) < 0.01, "Multi-start registration did not find the rotation"
+    assert np.abs(reg.rigid_matrix(x) - Th).max() < 0.5, "Multi-start registration did not find the translation"
+    assert S[-1] > 0.99, "Multi-start registration did not converge"
+
+    print('Test successful!')
+
+
+def bspline_test():
+
+    I = plt.imread('../data/image_data/1_1_t1.tif')
+    Im = plt.imread('../data/image_data/1_1_t1_d.tif')
+
+    spacing = 32
+    grid_size = reg.bspline_grid_size(I.shape, spacing)
+    x = np.random.randn(2*grid_size[0]*grid_size[1])*0.01
+
+    # zero displacements leave the image unchanged
+    Im_t, D, _, _ = reg.bspline_transform(Im, np.zeros_like(x), spacing)
+    assert np.array_equal(Im_t, Im), "B-spline transformation without displacement changes the image"
+
+    # the derivative along the analytic gradient direction (computed
+    # with finite differences) must equal the norm of the gradient
+    I_s = ndimage.gaussian_filter(I.astype(float), 2)
+    Im_s = ndimage.gaussian_filter(Im.astype(float), 2)
+    _, _, _, g = reg.bspline_corr_agrad(I_s, Im_s, x, spacing=spacing)
+    d = g/np.linalg.norm(g)
+    h = 1e-4
+    g_num = (reg.bspline_corr_agrad(I_s, Im_s, x+h*d, spacing=spacing)[0] -
+             reg.bspline_corr_agrad(I_s, Im_s, x-h*d, spacing=spacing)[0])/(2*h)
+    assert abs(g_num - np.linalg.norm(g)) < 0.1*np.linalg.norm(g), "B-spline gradient is incorrectly implemented"
+    _, _, _, g2 = reg.bspline_corr_agrad(I_s, Im_s, x, spacing=spacing, gradients=reg.image_gradient(Im_s))
+    assert np.array_equal(g, g2), "B-spline gradient with a precomputed image gradient is incorrect"
+
+    x, S, Im_t = reg.bspline_registration(I, Im, spacing=spacing, num_iter=20)
+    assert reg.correlation(I, Im_t) > reg.correlation(I, Im), "B-spline registration does not improve the correlation"
+
+    print('Test successful!')
+
+
+def phase_correlation_test():
+
+    I = plt.imread('../data/image_data/1_1_t1.tif')
+
+    # large rotation about the image center and translation, far outside
+    # the reach of gradient ascent from the identity
+    c = (np.array(I.shape[::-1]) - 1) / 2
+    R = reg.rotate(2.0)
+    Th = util.t2h(R, c - R.dot(c) + np.array([7, -4]))
+    Im, _ = reg.image_transform(I, util.inv_h(Th))
+
+    # J(p) = I(p + [5, -3]), so J translated by [5, -3] is I
+    t, peak = reg.phase_correlation(I, np.roll(I, (3, -5), axis=(0, 1)))
+    assert np.allclose(t, [5, -3]) and np.isclose(peak, 1), "Phase correlation translation is incorrect"
+
+    x = reg.phase_correlation_init(I, Im)
+    Th_init = util.t2h(reg.rotate(x[0]), x[1:]*100)
+    assert abs(x[0] - 2.0) < 0.005, "Rotation estimate is incorrect"
+    assert np.abs(Th_init - Th).max() < 0.5, "Translation estimate is incorrect"
+
+    x = reg.phase_correlation_init(I, Im, affine=True)
+    assert x.shape == (7,) and np.allclose(x[1:5], [1, 1, 0, 0]), "Affine initial parameters are incorrect"
+
+    # non-square images (a frequency index is a different frequency
+    # along the two axes of their spectra)
+    for I_crop in (I[:, 40:248], I[44:244]):
+        c = (np.array(I_crop.shape[::-1]) - 1) / 2
+        for angle in (0.3, 1.0):
+            R = reg.rotate(angle)
+            Th = util.t2h(R, c - R.dot(c) + np.array([7, -4]))
+            Im, _ = reg.image_transform(I_crop, util.inv_h(Th))
+            x = reg.phase_correlation_init(I_crop, Im)
+            Th_init = util.t2h(reg.rotate(x[0]), x[1:]*100)
+            assert abs(x[0] - angle) < 0.005, "Rotation estimate of a non-square image is incorrect"
+            assert np.abs(Th_init - Th).max() < 0.5, "Translation estimate of a non-square image is incorrect"
+
+    print('Test successful!')
+
+
 def registration_metrics_demo(use_t2=False):
 
     # read a T1 image
@@ -324,22 +960,22 @@ def registration_metrics_demo(use_t2=False):
 
     # used for rotation around image center
     t = np.array([I.shape[0], I.shape[1]])/2 + 0.5
-    T_1 = util.t2h(reg.identity(), t)
-    T_3 = util.t2h(reg.identity(), -t)
+    T_1 = reg.Transform(util.t2h(reg.identity(), t))
+    T_3 = reg.Transform(util.t2h(reg.identity(), -t))
+
+    # transformation matrices for rotating the image I by every angle
+    # around its center point
+    T_rot = np.array([(T_1 @ reg.Transform.rigid([ang, 0, 0]) @ T_3).matrix for ang in angles])
+
+    if use_t2:
+        # rotate the T2 image
+        J_all = reg.image_transform_batch(I_t2, T_rot)
+    else:
+        # rotate the T1 image
+        J_all = reg.image_transform_batch(I, T_rot)
 
     # loop over the rotation angles
-    for k, ang in enumerate(angles):
-        # transformation matrix for rotating the image
-        # I by angles(k) around its center point
-        T_2 = util.t2h(reg.rotate(ang), np.zeros(2))
-        T_rot = T_1.dot(T_2).dot(T_3)
-
-        if use_t2:
-            # rotate the T2 image
-            J, Xt = reg.image_transform(I_t2, T_rot)
-        else:
-            # rotate the T1 image
-            J, Xt = reg.image_transform(I, T_rot)
+    for k, J in enumerate(J_all):
 
         # compute the joint histogram with 16 bins
         p = reg.joint_histogram(I, J, 16, [0, 255])
@@ -2,10 +2,120 @@
 Utility functions for registration.
 """
 
+import json
+import time
+import threading
 import numpy as np
+from functools import lru_cache, wraps
+from contextlib import contextmanager, nullcontext
 from cpselect.cpselect import cpselect
 
 
+# Timing instrumentation. The registration code marks its stages
+# (coordinate mapping, interpolation, histogramming, ...) with
+# stage(name) blocks or the timed(name) decorator. When timing is
+# enabled, the number of calls and the cumulative time of every stage
+# are recorded; when it is disabled (the default) a stage only costs a
+# function call. Nested stages are all recorded, so the time of a stage
+# includes the time of the stages inside it. Timings are kept per
+# process; the threads of a process share them.
+
+_timings = None
+_timings_lock = threading.Lock()
+_NO_TIMING = nullcontext()
+
+
+def enable_timing(reset=True):
+    # Start recording the stage timings.
+    # Input:
+    # reset - discard the timings recorded before
+
+    global _timings
+    if reset or _timings is None:
+        _timings = {}
+
+
+def disable_timing():
+    # Stop recording the stage timings.
+    # Output:
+    # report - the timings recorded so far, see timing_report()
+
+    global _timings
+    report = timing_report()
+    _timings = None
+
+    return report
+
+
+def timing_report(as_json=False):
+    # Report of the recorded stage timings.
+    # Input:
+    # as_json - return the report as a JSON string
+    # Output:
+    # report - dictionary with per stage the number of calls and the
+    #          cumulative time in seconds, sorted by decreasing time
+
+    timings = _timings
+    if timings is None:
+        report = {}
+    else:
+        with _timings_lock:
+            items = [(name, calls, total) for name, (calls, total) in timings.items()]
+        report = {name: {'calls': calls, 'time': total}
+                  for name, calls, total in sorted(items, key=lambda item: -item[2])}
+
+    if as_json:
+        return json.dumps(report, indent=2)
+
+    return report
+
+
+@contextmanager
+def _timed_stage(name):
+    # the timings of the start of the stage are updated, also if timing
+    # is disabled (or reset) while the stage runs
+    timings = _timings
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _timings_lock:
+            record = timings.setdefault(name, [0, 0.0])
+            record[0] += 1
+            record[1] += elapsed
+
+
+def stage(name):
+    # Context manager that records the time of a block of code as the
+    # stage 'name' when timing is enabled.
+    # Input:
+    # name - name of the stage
+
+    if _timings is None:
+        return _NO_TIMING
+
+    return _timed_stage(name)
+
+
+def timed(name):
+    # Decorator that records every call of a function as the stage
+    # 'name' when timing is enabled.
+    # Input:
+    # name - name of the stage
+
+    def decorator(fun):
+        @wraps(fun)
+        def wrapper(*args, **kwargs):
+            if _timings is None:
+                return fun(*args, **kwargs)
+            with _timed_stage(name):
+                return fun(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
 def test_object(centered=True):
     # Generate an F-like test object.
     # Input:
@@ -36,22 +146,83 @@ def c2h(X):
 
 
 def t2h(T, t):
-    # Convert a 2D transformation matrix to homogeneous form.
+    # Convert a 2D (or 3D) transformation matrix to homogeneous form.
     # Input:
-    # T - 2D transformation matrix
-    # t - 2D translation vector
+    # T - 2D (or 3D) transformation matrix
+    # t - 2D (or 3D) translation vector
     # Output:
     # Th - homogeneous transformation matrix
 
     #------------------------------------------------------------------#
     t = t[np.newaxis, :]
     Th_1 = np.concatenate((T,t.T),1) #t.T is zelfde als np.transpose(t)
-    Th = np.concatenate((Th_1, np.array([[0,0,1]])),0)
+    last_row = np.zeros((1, Th_1.shape[1]))
+    last_row[0, -1] = 1
+    Th = np.concatenate((Th_1, last_row),0)
     return Th
     
     #------------------------------------------------------------------#
 
 
+@timed('inverse')
+def inv_h(Th):
+    # Inverse of a 2D (or 3D) homogeneous transformation matrix.
+    # Affine matrices (last row [0, ..., 0, 1]) are inverted as
+    # inv([T, t; 0, 1]) = [inv(T), -inv(T)t; 0, 1], in closed form for
+    # 2D matrices.
+    # Input:
+    # Th - homogeneous transformation matrix
+    # Output:
+    # Th_inv - inverse of Th
+
+    Th = np.asarray(Th, dtype=float)
+    n = Th.shape[0] - 1
+
+    if np.any(Th[n,:n] != 0) or Th[n,n] != 1:
+        return np.linalg.inv(Th)
+
+    if n != 2:
+        T_inv = np.linalg.inv(Th[:n,:n])
+        return t2h(T_inv, -T_inv.dot(Th[:n,n]))
+
+    a, b, tx = Th[0]
+    c, d, ty = Th[1]
+    det = a*d - b*c
+
+    if det == 0:
+        raise np.linalg.LinAlgError("Singular matrix")
+
+    Th_inv = np.array([[d/det, -b/det, (b*ty - d*tx)/det],
+                       [-c/det, a/det, (c*tx - a*ty)/det],
+                       [0, 0, 1]])
+
+    return Th_inv
+
+
+@timed('sampling_grid')
+@lru_cache(maxsize=8)
+def sampling_grid(*shape, dtype=np.float64):
+    # Homogeneous coordinates of all pixels (voxels) of an image. The
+    # result is cached per image size and type and read-only, so it can
+    # be shared between all image transformations of the same size.
+    # Input:
+    # shape - size of the image (2D or 3D)
+    # dtype - floating point type of the coordinates
+    # Output:
+    # Xh - (n+1)-by-p matrix for an n-dimensional image, with the
+    #      coordinates along the last image axis (x, columns) in the
+    #      first row, along the axis before it (y, rows) in the second
+    #      row and so on, and ones in the last row
+
+    n = len(shape)
+
+    Xh = np.ones((n+1, int(np.prod(shape))), dtype=dtype)
+    Xh[:n,:] = np.indices(shape).reshape(n, -1)[::-1]
+    Xh.flags.writeable = False
+
+    return Xh
+
+
 def plot_object(ax, X):
     # Plot 2D object.
 
@@ -6,13 +6,21 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 from scipy import ndimage
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 
-def ngradient(fun, x, h=1e-3):
+def ngradient(fun, x, h=1e-3, executor=None, num_workers=None):
     # Computes the derivative of a function with numerical differentiation.
     # Input:
     # fun - function for which the gradient is computed
     # x - vector of parameter values at which to compute the gradient
     # h - a small positive number used in the finite difference formula
+    # executor - None to evaluate the function serially, 'thread' or
+    #            'process' to evaluate all 2*x.size perturbations in a
+    #            new thread or process pool, or an existing
+    #            concurrent.futures executor. For processes fun must be
+    #            picklable, so no lambda functions (use functools.partial).
+    # num_workers - number of workers of a new pool (default: number of
+    #               processors)
     # Output:
     # g - vector of partial derivatives (gradient) of fun
 
@@ -21,14 +29,29 @@ def ngradient(fun, x, h=1e-3):
     # the function at x with numerical differentiation.
     # g[k] should store the partial derivative w.r.t. the k-th parameter
 
-    g = np.zeros_like(x)
+    X = []
     for k in range(x.size):
         xh1 = x.copy()
         xh2 = x.copy()
         xh1[k] = xh1[k] + h/2
         xh2[k] = xh2[k] - h/2
-        a = fun(xh1)
-        b = fun(xh2)
+        X.extend([xh1, xh2])
+
+    if executor is None:
+        F = [fun(xk) for xk in X]
+    elif isinstance(executor, Executor):
+        F = list(executor.map(fun, X))
+    elif executor in ('thread', 'process'):
+        pool = ThreadPoolExecutor if executor == 'thread' else ProcessPoolExecutor
+        with pool(max_workers=num_workers) as pool:
+            F = list(pool.map(fun, X))
+    else:
+        raise AssertionError("Unknown executor: " + str(executor))
+
+    g = np.zeros_like(x)
+    for k in range(x.size):
+        a = F[2*k]
+        b = F[2*k+1]
         if isinstance(a, tuple):
             g[k] = (a[0] -b[0])/h
         else: